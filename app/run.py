@@ -9,6 +9,7 @@ from app.tspea.utils import gen_out_dir_name
 TYPE = os.getenv('TYPE', 'worker')
 CITIES_FILE = os.getenv('CITIES_FILE', None)
 BROKER_URL = os.getenv('BROKER_URL', None)
+BACKEND = os.getenv('BACKEND', 'rabbitmq')
 OUT_DIR = os.getenv('OUT_DIR', gen_out_dir_name())
 
 setup_logging(OUT_DIR)
@@ -18,10 +19,14 @@ if __name__ == '__main__':
     if CITIES_FILE is None:
         Log.error('No problem file provided!')
         sys.exit(1)
-    if BROKER_URL is None:
+    if BACKEND not in ('rabbitmq', 'local'):
+        Log.error('Unknown backend %s!' % BACKEND)
+        sys.exit(1)
+    # the local backend executes the tasks in the master process' pool, islands still migrate over the broker
+    if BROKER_URL is None and (TYPE == 'worker' or BACKEND == 'rabbitmq' or master.ISLAND_ID is not None):
         Log.error('No message broker is specified!')
         sys.exit(1)
     if TYPE == 'worker':
         worker.run(CITIES_FILE, BROKER_URL)
     else:
-        master.run(CITIES_FILE, BROKER_URL, OUT_DIR)
+        master.run(CITIES_FILE, BROKER_URL, OUT_DIR, backend=BACKEND)
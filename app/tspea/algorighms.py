@@ -1,14 +1,24 @@
 import random
 import logging
+import collections
 import os
 import csv
+import numpy as np
 from deap import tools
-from .messaging import ID, FIRST, SECOND, GEN, TYPE, MATE, MUTATE
+from .messaging import ID, FIRST, SECOND, GEN, TYPE, MUTATE, MATE_MUTATE, EVALUATE, CONSTRUCT, OPTIMIZE, WINDOW, \
+    START, END, OFFSET, GAIN, METHOD, SEED, MUTATE_FIRST, MUTATE_SECOND, FITNESS, FITNESS_FIRST, FITNESS_SECOND, MOVES
+from .population import individual_from, generate_population, save_best_individual
+from .telemetry import NullGenerationTimer
+from .moves import apply_moves
 from collections.abc import Iterable
 
 Log = logging.getLogger(__name__)
 _STATS_DELIMITER = ','
 
+# phases timed by the generation timer, the steady-state algorithm times its report intervals the same way
+GENERATION_PHASES = ['select', 'vary_prepare', 'vary_publish', 'vary_wait', 'evaluate', 'halloffame', 'replace',
+                     'migrate', 'save_population', 'stats']
+
 
 def write_stats(header, stats, stats_file):
     out_file_exists = os.path.exists(stats_file)
@@ -26,106 +36,450 @@ def load_stats(stats_file):
         return [row for row in reader]
 
 
-def _apply_to_population(pop, idxs, inds_vals):
-    if isinstance(idxs, Iterable):
-        for idx, ind_vals in zip(idxs, inds_vals):
-            for i in range(len(pop[idx])):
-                pop[idx][i] = ind_vals[i]
-    else:
-        for i in range(len(pop[idxs])):
-            pop[idxs][i] = inds_vals[i]
-
-
-def _var_and(population, toolbox, cxpb, mutpb, gen):
-    offspring = [toolbox.clone(ind) for ind in population]
-
-    # Apply crossover and mutation on the offspring
-    mate_tasks = []
-    for i in range(1, len(offspring), 2):
-        if random.random() < cxpb:
-            mate_tasks.append({ID: (i-1, i), TYPE: MATE, GEN: gen,
-                               FIRST: list(offspring[i-1]),
-                               SECOND: list(offspring[i])})
-            del offspring[i - 1].fitness.values, offspring[i].fitness.values
-    Log.info('Performing crossover...')
-    mate_results = toolbox.publish_tasks(mate_tasks)
-    for r in mate_results:
-        _apply_to_population(offspring, r[ID], [r[FIRST], r[SECOND]])
-
-    mutate_tasks = []
-    for i in range(len(offspring)):
-        if random.random() < mutpb:
-            mutate_tasks.append({ID: i, TYPE: MUTATE, GEN: gen, FIRST: list(offspring[i])})
-            del offspring[i].fitness.values
-    Log.info('Performing mutation...')
-    mutate_results = toolbox.publish_tasks(mutate_tasks)
-    for r in mutate_results:
-        _apply_to_population(offspring, r[ID], r[FIRST])
-
-    return offspring
-
-
-def ea_simple(population, toolbox, cxpb, mutpb, ngen, stats=None, halloffame=None, verbose=__debug__, elitism=True):
+def _cached_fitness(ind, toolbox):
+    """
+    Looks the tour up in the fitness cache of the toolbox (hooks tour_hash, cached_fitness and cache_fitness).
+    :return: Tuple (hash of the tour, cached fitness value or None), the hash is None if there is no cache
+    """
+    if not hasattr(toolbox, 'tour_hash'):
+        return None, None
+    tour_hash = toolbox.tour_hash(ind)
+    return tour_hash, toolbox.cached_fitness(tour_hash)
+
+
+def _cache_fitness(tour_hash, fitness, toolbox):
+    if tour_hash is not None:
+        toolbox.cache_fitness(tour_hash, fitness)
+
+
+def _apply_result(pop, idxs, result, toolbox):
+    """
+    Writes the offspring of a task result into the population and assigns their fitness values: the cached one for
+    known tours, otherwise the one computed by the worker, spot-checked by the check_fitness hook of the toolbox if
+    there is one. Offspring without a fitness value are left invalid. A mutation result can consist of the moves
+    which turn the individual of the task, still in the population, into the offspring. A skipped mutation leaves
+    the individual unmutated.
+    """
+    idxs = idxs if isinstance(idxs, Iterable) else [idxs]
+    for idx, key, fitness_key in zip(idxs, (FIRST, SECOND), (FITNESS_FIRST, FITNESS_SECOND)):
+        if key in result:
+            np.frombuffer(pop[idx], dtype=np.int32)[:] = result[key]
+        elif MOVES in result:
+            apply_moves(np.frombuffer(pop[idx], dtype=np.int32), result[MOVES])
+        tour_hash, fitness = _cached_fitness(pop[idx], toolbox)
+        if fitness is None and fitness_key in result:
+            fitness = result[fitness_key]
+            if hasattr(toolbox, 'check_fitness'):
+                fitness = toolbox.check_fitness(pop[idx], fitness)
+            _cache_fitness(tour_hash, fitness, toolbox)
+        if fitness is not None:
+            pop[idx].fitness.values = fitness,
+
+
+def evaluate_remotely(individuals, publish_tasks):
+    """
+    Evaluates the individuals on the workers.
+    :return: List of fitness tuples, one per individual
+    """
+    tasks = [{ID: i, TYPE: EVALUATE, GEN: 0, FIRST: ind} for i, ind in enumerate(individuals)]
+    fitnesses = [None] * len(individuals)
+    for r in publish_tasks(tasks):
+        fitnesses[r[ID]] = r[FITNESS_FIRST],
+    return fitnesses
+
+
+def construct_population(num_cities, pop_size, ratios, publish_tasks):
+    """
+    Generates an initial population with the construction heuristics of the workers.
+    :param ratios: Dict of the construction methods to their share of the population, the remaining individuals
+                   are random permutations
+    """
+    methods = [method for method, ratio in ratios.items() for _ in range(int(round(ratio * pop_size)))][:pop_size]
+    tasks = [{ID: i, TYPE: CONSTRUCT, GEN: 0, METHOD: method, SEED: random.randrange(2 ** 31)}
+             for i, method in enumerate(methods)]
+    population = [None] * len(tasks)
+    for r in publish_tasks(tasks):
+        ind = individual_from(r[FIRST])
+        ind.fitness.values = r[FITNESS_FIRST],
+        population[r[ID]] = ind
+    Log.info('Constructed %d individuals' % len(population))
+    return population + generate_population(num_cities, pop_size - len(population))
+
+
+def optimize_remotely(individual, publish_tasks):
+    """
+    Runs the optimizer of the workers on a copy of the individual.
+    :return: Tuple with the optimized copy
+    """
+    optimized = individual_from(individual)
+    for r in publish_tasks([{ID: 0, TYPE: OPTIMIZE, GEN: 0, FIRST: individual}]):
+        if r[ID] != 0:
+            Log.warning('Ignoring the result of task %s, which is not the optimization' % (r[ID],))
+            continue
+        if FIRST in r:
+            np.frombuffer(optimized, dtype=np.int32)[:] = r[FIRST]
+        else:
+            apply_moves(np.frombuffer(optimized, dtype=np.int32), r[MOVES])
+        optimized.fitness.values = r[FITNESS_FIRST],
+    return optimized,
+
+
+def optimize_windows(individual, publish_tasks, num_windows):
+    """
+    Optimizes a copy of the individual on the workers in parallel: the tour is cut into num_windows windows at random
+    offsets, each window being optimized on its own between the fixed cities which separate it from its neighbours.
+    The optimized windows are put back in place.
+    :return: Tuple with the optimized copy
+    """
+    optimized = individual_from(individual)
+    tour = np.frombuffer(optimized, dtype=np.int32)
+    size = max(len(tour) // num_windows, 1)
+    # positions of the separating cities, the enclosing city 0 is at -1 and len(tour)
+    separators = [-1] + list(range(random.randrange(size), len(tour), size)) + [len(tour)]
+    tasks, windows = [], {}
+    for lo, hi in zip(separators[:-1], separators[1:]):
+        lo, hi = lo + 1, hi - 1
+        if hi - lo < 2:
+            continue
+        windows[len(tasks)] = lo, hi
+        tasks.append({ID: len(tasks), TYPE: WINDOW, GEN: 0, FIRST: tour[lo:hi + 1].copy(),
+                      START: int(tour[lo - 1]) if lo > 0 else 0, END: int(tour[hi + 1]) if hi + 1 < len(tour) else 0,
+                      OFFSET: lo})
+    gain = 0.
+    for r in publish_tasks(tasks):
+        if r[ID] not in windows:
+            Log.warning('Ignoring the result of task %s, which is not a window' % (r[ID],))
+            continue
+        lo, hi = windows[r[ID]]
+        tour[lo:hi + 1] = r[FIRST]
+        gain += r[GAIN]
+    optimized.fitness.values = individual.fitness.values[0] - gain,
+    return optimized,
+
+
+class BestOptimizer(object):
+    """
+    Runs a tour optimizer, e.g. the prime penalty optimizer, on the best individual of a hall of fame every `every`
+    calls, if that individual changed. The optimized tour enters the hall of fame if it is shorter.
+    """
+    def __init__(self, optimize, every=1):
+        self.optimize = optimize
+        self.every = every
+        self.calls = 0
+        self.optimized = None
+
+    def __call__(self, halloffame, force=False):
+        self.calls += 1
+        if not force and self.calls % self.every != 0:
+            return
+        if not len(halloffame) or halloffame[0].tobytes() == self.optimized:
+            return
+        best = individual_from(halloffame[0])
+        best.fitness.values = halloffame[0].fitness.values
+        optimized, = self.optimize(best)
+        if optimized.fitness.valid and optimized.fitness > halloffame[0].fitness:
+            Log.info('Optimized the best individual: %f -> %f' % (halloffame[0].fitness.values[0],
+                                                                 optimized.fitness.values[0]))
+            halloffame.update([optimized])
+        self.optimized = halloffame[0].tobytes()
+
+
+def save_optimized_best(halloffame, out_dir, optimize_best):
+    optimize_best(halloffame)
+    save_best_individual(halloffame, out_dir)
+
+
+def _evaluate_initial(population, toolbox):
+    """
+    Evaluates the individuals with an invalid fitness, on the workers if the toolbox has an evaluate_remotely hook.
+    Known tours and copies of a tour are evaluated once.
+    :return: Number of evaluated individuals
+    """
+    unknown = collections.OrderedDict()  # tour -> individuals
+    for ind in population:
+        tour_hash, fitness = _cached_fitness(ind, toolbox)
+        if ind.fitness.valid:
+            _cache_fitness(tour_hash, ind.fitness.values[0], toolbox)
+        elif fitness is not None:
+            ind.fitness.values = fitness,
+        else:
+            unknown.setdefault(tour_hash if tour_hash is not None else ind.tobytes(), []).append(ind)
+    evaluate = toolbox.evaluate_remotely if hasattr(toolbox, 'evaluate_remotely') else toolbox.evaluate_population
+    fitnesses = evaluate([copies[0] for copies in unknown.values()])
+    for (key, copies), fit in zip(unknown.items(), fitnesses):
+        for ind in copies:
+            ind.fitness.values = fit
+        if hasattr(toolbox, 'tour_hash'):
+            _cache_fitness(key, fit[0], toolbox)
+    return len(unknown)
+
+
+def _generation_timer(toolbox):
+    return toolbox.generation_timer() if hasattr(toolbox, 'generation_timer') else NullGenerationTimer()
+
+
+def _var_and(population, toolbox, cxpb, mutpb, gen, timer=NullGenerationTimer(), dedupe=False):
+    with timer.phase('vary_prepare'):
+        offspring = [toolbox.clone(ind) for ind in population]
+
+        # Mutation is decided up front, so that mated offspring are mutated by the worker which mates them
+        mutants = [random.random() < mutpb for _ in offspring]
+        if dedupe:
+            # copies of an individual selected more than once are all mutated, so they do not stay copies
+            seen = set()
+            for i, ind in enumerate(offspring):
+                tour = ind.tobytes()
+                mutants[i] = mutants[i] or tour in seen
+                seen.add(tour)
+        tasks, mated = [], set()
+        for i in range(1, len(offspring), 2):
+            # mating copies of the same individual yields the same copies again
+            if random.random() < cxpb and not (dedupe and offspring[i - 1] == offspring[i]):
+                tasks.append({ID: (i-1, i), TYPE: MATE_MUTATE, GEN: gen,
+                              FIRST: offspring[i-1],
+                              SECOND: offspring[i],
+                              MUTATE_FIRST: mutants[i-1],
+                              MUTATE_SECOND: mutants[i]})
+                del offspring[i - 1].fitness.values, offspring[i].fitness.values
+                mated.update((i - 1, i))
+        for i in range(len(offspring)):
+            if mutants[i] and i not in mated:
+                tasks.append({ID: i, TYPE: MUTATE, GEN: gen, FIRST: offspring[i]})
+                del offspring[i].fitness.values
+    Log.info('Performing crossover and mutation...')
+    with timer.phase('vary_publish'):
+        results = toolbox.publish_tasks(tasks)
+    with timer.phase('vary_wait'):
+        for r in results:
+            _apply_result(offspring, r[ID], r, toolbox)
+
+    return offspring, sum(len(t[ID]) if isinstance(t[ID], tuple) else 1 for t in tasks)
+
+
+def migrate(population, gen, migrator, interval, num_migrants):
+    """
+    Island model migration step: every interval generations the best num_migrants individuals are sent to the
+    neighbouring islands and the migrants received in the meantime replace the worst individuals.
+    :return: List of the immigrants inserted into the population
+    """
+    if gen % interval != 0:
+        return []
+    migrator.emigrate(tools.selBest(population, num_migrants))
+    immigrants = []
+    for m in migrator.immigrate()[:len(population) - 1]:
+        ind = individual_from(m[FIRST])
+        ind.fitness.values = m[FITNESS],
+        immigrants.append(ind)
+    worst_idxs = sorted(range(len(population)), key=lambda i: population[i].fitness)[:len(immigrants)]
+    for idx, ind in zip(worst_idxs, immigrants):
+        population[idx] = ind
+    if immigrants:
+        Log.info('Received %d migrants' % len(immigrants))
+    return immigrants
+
+
+def ea_simple(population, toolbox, cxpb, mutpb, ngen, stats=None, halloffame=None, verbose=__debug__, elitism=True,
+              start_gen=None, dedupe=False):
 
     logbook = tools.Logbook()
     logbook.header = ['gen', 'nevals'] + (stats.fields if stats else [])
 
     # Evaluate the individuals with an invalid fitness
-    invalid_ind = [ind for ind in population if not ind.fitness.valid]
-    fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-    for ind, fit in zip(invalid_ind, fitnesses):
-        ind.fitness.values = fit
+    nevals = _evaluate_initial(population, toolbox)
 
     if halloffame is not None:
         halloffame.update(population)
 
     record = stats.compile(population) if stats else {}
-    logbook.record(gen=0, nevals=len(invalid_ind), **record)
+    logbook.record(gen=0, nevals=nevals, **record)
     if verbose:
         Log.info(logbook.stream)
 
     if stats:
         toolbox.write_stats(stats.fields, [record[f] for f in stats.fields])
 
-    current_gen = len(toolbox.load_stats())
+    current_gen = start_gen if start_gen is not None else len(toolbox.load_stats())
 
     # Begin the generational process
+    timer = _generation_timer(toolbox)
     for gen in range(current_gen, ngen + 1):
         # Select the next generation individuals
-        offspring = toolbox.select(population, len(population))
+        with timer.phase('select'):
+            offspring = toolbox.select(population, len(population))
 
-        # Vary the pool of individuals
-        offspring = _var_and(offspring, toolbox, cxpb, mutpb, gen)
+        # Vary the pool of individuals, the workers return the fitness of the offspring
+        offspring, nevals = _var_and(offspring, toolbox, cxpb, mutpb, gen, timer, dedupe)
 
-        # Evaluate the individuals with an invalid fitness
-        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-        for ind, fit in zip(invalid_ind, fitnesses):
-            ind.fitness.values = fit
+        # Evaluate the individuals whose fitness was not returned
+        with timer.phase('evaluate'):
+            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+            fitnesses = toolbox.evaluate_population(invalid_ind)
+            for ind, fit in zip(invalid_ind, fitnesses):
+                ind.fitness.values = fit
 
         # Update the hall of fame with the generated individuals
-        if halloffame is not None:
-            halloffame.update(offspring)
+        with timer.phase('halloffame'):
+            if halloffame is not None:
+                halloffame.update(offspring)
 
         # Replace the current population by the offspring
-        if elitism:
-            _, bp = _find_extreme_individual(population, _cmp)
-            wo_idx, _ = _find_extreme_individual(offspring, cmp=lambda a, b: -_cmp(a, b))
-            population[:] = offspring
-            population[wo_idx] = bp  # replace worst offspring with best parent
-        else:
-            population[:] = offspring
-
-        toolbox.save_population(population)
+        with timer.phase('replace'):
+            if elitism:
+                _, bp = _find_extreme_individual(population, _cmp)
+                wo_idx, _ = _find_extreme_individual(offspring, cmp=lambda a, b: -_cmp(a, b))
+                population[:] = offspring
+                population[wo_idx] = bp  # replace worst offspring with best parent
+            else:
+                population[:] = offspring
+
+        with timer.phase('migrate'):
+            if hasattr(toolbox, 'migrate'):
+                immigrants = toolbox.migrate(population, gen)
+                if halloffame is not None:
+                    halloffame.update(immigrants)
+
+        with timer.phase('save_population'):
+            toolbox.save_population(population, gen=gen)
 
         # Append the current generation statistics to the logbook
-        record = stats.compile(population) if stats else {}
-        logbook.record(gen=gen, nevals=len(invalid_ind), **record)
-        if verbose:
-            print(logbook.stream)
-        if stats:
-            toolbox.write_stats(stats.fields, [record[f] for f in stats.fields])
-        toolbox.save_best_individual(halloffame)
+        with timer.phase('stats'):
+            record = stats.compile(population) if stats else {}
+            logbook.record(gen=gen, nevals=nevals, **record)
+            if verbose:
+                print(logbook.stream)
+            if stats:
+                toolbox.write_stats(stats.fields, [record[f] for f in stats.fields])
+            toolbox.save_best_individual(halloffame)
+        timer.finish(gen)
+    return population, logbook
+
+
+def _new_steady_state_task(population, toolbox, cxpb, mutpb, task_id, dedupe=False):
+    parents = toolbox.select(population, 2 if random.random() < cxpb else 1)
+    # mating copies of the same individual yields the same copies again
+    if len(parents) == 2 and not (dedupe and parents[0] == parents[1]):
+        offspring = [toolbox.clone(ind) for ind in parents]
+        task = {ID: task_id, TYPE: MATE_MUTATE, GEN: 0,
+                FIRST: offspring[0],
+                SECOND: offspring[1],
+                MUTATE_FIRST: random.random() < mutpb,
+                MUTATE_SECOND: random.random() < mutpb}
+    else:
+        # without crossover the offspring is always mutated, otherwise it would be a copy of its parent
+        offspring = [toolbox.clone(parents[0])]
+        task = {ID: task_id, TYPE: MUTATE, GEN: 0, FIRST: offspring[0]}
+    for ind in offspring:
+        del ind.fitness.values
+    return task, offspring
+
+
+def _replace_worst(population, ind, tournsize=None):
+    """
+    Replaces the worst individual of the population, or of a random tournament of tournsize individuals, with ind
+    if ind is better. Returns True if ind was inserted.
+    """
+    idxs = range(len(population)) if tournsize is None else random.sample(range(len(population)), tournsize)
+    widx = min(idxs, key=lambda i: population[i].fitness)
+    if population[widx].fitness < ind.fitness:
+        population[widx] = ind
+        return True
+    return False
+
+
+def ea_steady_state(population, toolbox, cxpb, mutpb, nevals, in_flight, report_every, stats=None, halloffame=None,
+                    replacement='worst', tournsize=3, verbose=__debug__, start_gen=None, dedupe=False):
+    """
+    Asynchronous steady-state evolution. A fixed number of tasks is kept in flight; every returned offspring is
+    evaluated and inserted into the population right away and a new task is published in its place, so there is
+    no barrier between generations. Statistics and checkpoints are emitted every report_every evaluations, which
+    also count as generations for the migration interval of the island model.
+    :param nevals: Number of offspring evaluations to perform
+    :param in_flight: Number of tasks kept in flight
+    :param report_every: Number of evaluations between statistics and checkpoints
+    :param replacement: 'worst' replaces the worst individual of the population, 'tournament' the worst of a random
+                        tournament of tournsize individuals, in both cases only if the offspring is better
+    :param start_gen: First report of a resumed run, the evaluations of the earlier reports count as done
+    :param dedupe: Copies of the same individual selected for mating are mutated instead of mated
+    """
+    logbook = tools.Logbook()
+    logbook.header = ['evals', 'inserted'] + (stats.fields if stats else [])
+
+    # Evaluate the individuals with an invalid fitness
+    _evaluate_initial(population, toolbox)
+
+    if halloffame is not None:
+        halloffame.update(population)
+
+    record = stats.compile(population) if stats else {}
+    logbook.record(evals=0, inserted=0, **record)
+    if verbose:
+        Log.info(logbook.stream)
+    if stats:
+        toolbox.write_stats(stats.fields, [record[f] for f in stats.fields])
+
+    tournsize = tournsize if replacement == 'tournament' else None
+    pending, next_task_id = {}, 0
+    reports = start_gen - 1 if start_gen is not None else 0
+    evals, inserted = min(reports * report_every, nevals), 0
+    issued, next_report = evals, evals + report_every
+
+    timer = _generation_timer(toolbox)
+
+    def submit():
+        nonlocal next_task_id, issued
+        with timer.phase('vary_prepare'):
+            task, offspring = _new_steady_state_task(population, toolbox, cxpb, mutpb, next_task_id, dedupe)
+            pending[next_task_id] = offspring
+            next_task_id += 1
+            issued += len(offspring)
+        with timer.phase('vary_publish'):
+            toolbox.submit_tasks([task])
+
+    while issued < nevals and len(pending) < in_flight:
+        submit()
+    results = iter(toolbox.task_results())
+    while True:
+        with timer.phase('vary_wait'):
+            r = next(results, None)
+        if r is None:
+            break
+        offspring = pending.pop(r[ID])
+        _apply_result(offspring, range(len(offspring)), r, toolbox)
+        with timer.phase('evaluate'):
+            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+            for ind, fit in zip(invalid_ind, toolbox.evaluate_population(invalid_ind)):
+                ind.fitness.values = fit
+        with timer.phase('replace'):
+            for ind in offspring:
+                inserted += int(_replace_worst(population, ind, tournsize))
+        with timer.phase('halloffame'):
+            if halloffame is not None:
+                halloffame.update(offspring)
+        evals += len(offspring)
+
+        # publish the next task before doing anything else, to keep the workers busy
+        if issued < nevals:
+            submit()
+
+        if evals >= next_report or not pending:
+            next_report += report_every
+            reports += 1
+            with timer.phase('migrate'):
+                if hasattr(toolbox, 'migrate'):
+                    immigrants = toolbox.migrate(population, reports)
+                    if halloffame is not None:
+                        halloffame.update(immigrants)
+            with timer.phase('save_population'):
+                toolbox.save_population(population, gen=reports)
+            with timer.phase('stats'):
+                record = stats.compile(population) if stats else {}
+                logbook.record(evals=evals, inserted=inserted, **record)
+                if verbose:
+                    Log.info(logbook.stream)
+                if stats:
+                    toolbox.write_stats(stats.fields, [record[f] for f in stats.fields])
+                toolbox.save_best_individual(halloffame)
+            timer.finish(reports)
     return population, logbook
 
 
@@ -0,0 +1,176 @@
+import numpy as np
+
+HILBERT = 'hilbert'
+NEAREST_NEIGHBOUR = 'nn'
+GREEDY_EDGE = 'greedy'
+METHODS = (HILBERT, NEAREST_NEIGHBOUR, GREEDY_EDGE)
+
+_HILBERT_ORDER = 16
+
+
+def _hilbert_keys(x, y, order=_HILBERT_ORDER):
+    """Positions of the integer points (x, y) in [0, 2^order)^2 along the Hilbert curve of that order."""
+    n = 1 << order
+    x, y = x.astype(np.int64), y.astype(np.int64)
+    keys = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant, so that the curve of the sub-square starts and ends at the right corners
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return keys
+
+
+def _hilbert_order(points, rng):
+    """
+    Order of the points along a Hilbert curve laid over them with a random rotation and offset, so that different
+    seeds cut the plane differently.
+    """
+    angle = rng.uniform(0, 2 * np.pi)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    rotated = points @ rotation
+    rotated -= rotated.min(axis=0)
+    span = max(float(rotated.max()), 1e-9)
+    # the curve covers a square twice as large as the points, placed at a random offset
+    scaled = (rotated + rng.uniform(0, span, size=2)) / (2 * span) * ((1 << _HILBERT_ORDER) - 1)
+    return np.argsort(_hilbert_keys(scaled[:, 0], scaled[:, 1]), kind='stable')
+
+
+def _individual(cycle):
+    """The individual of a cyclic order of all the cities: the cities following city 0, without it."""
+    cycle = np.asarray(cycle, dtype=np.int32)
+    start = int(np.nonzero(cycle == 0)[0][0])
+    return np.concatenate((cycle[start + 1:], cycle[:start]))
+
+
+class TourConstructor(object):
+    """
+    Randomized construction heuristics for the initial tours, running in O(n log n) or O(nk) with the candidate
+    lists of the k nearest neighbours:
+    - hilbert: order of the cities along a randomly rotated and shifted space-filling curve;
+    - nn: nearest neighbour from a random city, picking the second nearest unvisited candidate with probability
+      `randomness`. Once all the candidates are visited the walk continues with the closest unvisited city along the
+      Hilbert order;
+    - greedy: greedy edge matching on the candidate edges, their lengths perturbed by up to `randomness`, the
+      fragments being joined along the Hilbert order.
+    The direction of the tours is random as well.
+    """
+    def __init__(self, tsp_instance, neighbours, greedy_candidates=8, randomness=0.1):
+        self.points = np.asarray(tsp_instance.cities, dtype=np.float64)
+        self.neighbours = neighbours
+        self.greedy_candidates = greedy_candidates
+        self.randomness = randomness
+
+    def __distance(self, a, b):
+        dx, dy = self.points[a] - self.points[b]
+        return (dx * dx + dy * dy) ** 0.5
+
+    def hilbert(self, rng):
+        return _hilbert_order(self.points, rng)
+
+    def nearest_neighbour(self, rng):
+        n = len(self.points)
+        # unvisited cities in Hilbert order, as a circular doubly linked list
+        order = _hilbert_order(self.points, rng)
+        nxt, prv = np.empty(n, dtype=np.int64), np.empty(n, dtype=np.int64)
+        nxt[order], prv[order] = np.roll(order, -1), np.roll(order, 1)
+        nxt, prv = nxt.tolist(), prv.tolist()
+        neighbours = np.asarray(self.neighbours).tolist()
+        visited = bytearray(n)
+        cycle = []
+        current = int(rng.randint(n))
+        for _ in range(n - 1):
+            visited[current] = 1
+            cycle.append(current)
+            before, after = prv[current], nxt[current]
+            nxt[before], prv[after] = after, before
+            candidates = [c for c in neighbours[current] if not visited[c]][:2]
+            if candidates:
+                current = candidates[1] if len(candidates) > 1 and rng.random_sample() < self.randomness \
+                    else candidates[0]
+            else:
+                current = before if self.__distance(current, before) < self.__distance(current, after) else after
+        cycle.append(current)
+        return np.array(cycle)
+
+    def greedy_edge(self, rng):
+        n = len(self.points)
+        k = min(self.greedy_candidates, np.shape(self.neighbours)[1])
+        a = np.repeat(np.arange(n, dtype=np.int64), k)
+        b = np.asarray(self.neighbours)[:, :k].astype(np.int64).ravel()
+        a, b = np.minimum(a, b), np.maximum(a, b)
+        a, b = np.divmod(np.unique(a * n + b), n)
+        lengths = np.sqrt(np.sum(np.square(self.points[a] - self.points[b]), axis=1))
+        lengths *= 1 + self.randomness * rng.random_sample(len(lengths))
+        by_length = np.argsort(lengths, kind='stable')
+
+        degree = bytearray(n)
+        adjacent = [[] for _ in range(n)]
+        parent = list(range(n))
+
+        def find(c):
+            while parent[c] != c:
+                parent[c] = parent[parent[c]]
+                c = parent[c]
+            return c
+
+        for u, v in zip(a[by_length].tolist(), b[by_length].tolist()):
+            if degree[u] < 2 and degree[v] < 2:
+                ru, rv = find(u), find(v)
+                if ru != rv:
+                    parent[ru] = rv
+                    degree[u] += 1
+                    degree[v] += 1
+                    adjacent[u].append(v)
+                    adjacent[v].append(u)
+
+        # walk the fragments from their ends, isolated cities being fragments of their own
+        fragments, seen = [], bytearray(n)
+        for end in range(n):
+            if degree[end] < 2 and not seen[end]:
+                fragment, previous, current = [end], -1, end
+                seen[end] = 1
+                while True:
+                    following = [c for c in adjacent[current] if c != previous]
+                    if not following:
+                        break
+                    previous, current = current, following[0]
+                    seen[current] = 1
+                    fragment.append(current)
+                fragments.append(fragment)
+
+        # join the fragments in the Hilbert order of their first ends, each in the direction of the shorter link
+        keys = np.empty(n, dtype=np.int64)
+        keys[_hilbert_order(self.points, rng)] = np.arange(n)
+        fragments.sort(key=lambda f: keys[f[0]])
+        cycle = list(fragments[0])
+        for fragment in fragments[1:]:
+            if self.__distance(cycle[-1], fragment[-1]) < self.__distance(cycle[-1], fragment[0]):
+                fragment.reverse()
+            cycle.extend(fragment)
+        return np.array(cycle)
+
+    def __call__(self, method, seed=None):
+        """
+        Constructs a tour.
+        :param method: One of METHODS
+        :param seed: Seed of the randomization
+        :return: The individual of the tour, an int32 array
+        """
+        rng = np.random.RandomState(seed)
+        if method == HILBERT:
+            cycle = self.hilbert(rng)
+        elif method == NEAREST_NEIGHBOUR:
+            cycle = self.nearest_neighbour(rng)
+        elif method == GREEDY_EDGE:
+            cycle = self.greedy_edge(rng)
+        else:
+            raise ValueError('Unknown construction method: %s' % method)
+        individual = _individual(cycle)
+        return individual[::-1].copy() if rng.random_sample() < 0.5 else individual
@@ -1,46 +1,62 @@
 import numpy as np
-import itertools
-from operator import itemgetter
 
 
-def _edge_neighbors(ind, neighbour_lists):
+def _edge_neighbors(ind1, ind2):
     """
-    Auxiliary method which computes the list of neighbours of the individual and modifies in place the passed
-    neighbour_lists parameter which is assumed to be a numpy array of shape (len(ind) + 1, 4)
-    :param ind: Individual
-    :param neighbour_lists: List of neighbours, modified inplace
-    :return: The list of neighbours
+    Auxiliary method which computes the neighbour lists of the union of the edges of both individuals.
+    Row c lists the successor and predecessor of city c in the first individual, followed by its successor and
+    predecessor in the second one, absent neighbours (at the ends of the tours) being skipped. Edges common to
+    both individuals appear twice. The first row is unused: cities are enumerated starting from 1.
+    :param ind1: First individual
+    :param ind2: Second individual
+    :return: Numpy array of shape (len(ind1) + 1, 4), -1 represents absence of neighbour
     """
-    lind = len(ind)
-    for i in range(lind):
-        k = 0
-        while neighbour_lists[ind[i]][k] != -1:
-            k += 1
-        if i < lind - 1:
-            neighbour_lists[ind[i]][k] = ind[i + 1]
-            k += 1
-        if i > 0:
-            neighbour_lists[ind[i]][k] = ind[i - 1]
-    return neighbour_lists
-
-
-def _choose_set_pos(vec):
+    lind = len(ind1)
+    slots = np.full((4, lind + 1), -1, dtype=np.int64)
+    for k, ind in enumerate((ind1, ind2)):
+        ind = np.asarray(ind, dtype=np.int64)
+        slots[2 * k, ind[:-1]] = ind[1:]
+        slots[2 * k + 1, ind[1:]] = ind[:-1]
+    slots = slots.T
+    # move absent neighbours to the end of the rows keeping the order of the others
+    return np.take_along_axis(slots, np.argsort(slots == -1, axis=1, kind='stable'), axis=1)
+
+
+def _find(parent, j):
+    while parent[j] != j:
+        parent[j] = parent[parent[j]]
+        j = parent[j]
+    return j
+
+
+class _RemainingSet(object):
     """
-    Auxiliary method which accepts a bit-vector and selects one set position randomly.
-    :param vec: Bit-vector
-    :return: Random set position. None if vector is all zeros.
+    Set of the positions 0..size-1 not yet used, supporting O(1) amortized removal and lookup of the nearest
+    remaining position on both sides of any position (union-find with path halving).
     """
-    lvec = len(vec)
-    i = np.random.randint(lvec)
-    k = 0
-    while -1 < i - k or i + k < lvec:
-        sign = np.random.choice([-1, 1])
-        if -1 < i + sign * k < lvec and vec[i + sign * k] != 0:
-            return i + sign * k
-        if -1 < i - sign * k < lvec and vec[i - sign * k] != 0:
-            return i - sign * k
-        k += 1
-    return None
+    def __init__(self, size):
+        self.size = size
+        self.next = list(range(size + 1))  # next[size] is a sentinel
+        self.prev = list(range(size + 1))  # prev is shifted by one, prev[0] is a sentinel
+
+    def remove(self, j):
+        self.next[j] = j + 1
+        self.prev[j + 1] = j
+
+    def nearest(self, i):
+        """
+        Nearest remaining position to i, ties broken randomly. None if the set is empty.
+        """
+        right, left = _find(self.next, i), _find(self.prev, i + 1) - 1
+        if right == self.size and left == -1:
+            return None
+        if right == self.size:
+            return left
+        if left == -1:
+            return right
+        if right - i == i - left:
+            return right if np.random.random() < 0.5 else left
+        return right if right - i < i - left else left
 
 
 def edge_recombination(ind1, ind2):
@@ -48,37 +64,130 @@ def edge_recombination(ind1, ind2):
     Implements the edge recombination crossover operator as described in
     `Link text <http://www.rubicite.com/Tutorials/GeneticAlgorithms/CrossoverOperators/EdgeRecombinationCrossoverOperator.aspx>`_
     Returns a tuple of identical individuals result of the crossover.
+    Runs in linear time: a placed city is removed only from the lists of its own neighbours, the neighbour counts
+    are maintained incrementally and the unplaced cities are kept in a union-find structure for the restarts.
     :param ind1: First individual
     :param ind2: Second individual
     :return: Tuple of two individuals
     """
     ilen = len(ind1)
-    # neighbours lists as numpy array of shape (ilen + 1, 4), -1 represents absence of neighbour
-    # note that the first row is unused: array indexing starts from 0, cities are enumerated starting from 1
-    nlists = np.full((ilen + 1, 4), -1)
-    _edge_neighbors(ind1, nlists)
-    _edge_neighbors(ind2, nlists)
-    i, off = 0, np.empty(ilen, dtype=int)
+    nlists = _edge_neighbors(ind1, ind2).tolist()
+    counts = [4 - row.count(-1) for row in nlists]
+    i, off = 0, [0] * ilen
     x = ind1[0] if np.random.random() < 0.5 else ind2[0]  # randomly choose the first node from the individuals
-    remaining = np.ones((ilen,), dtype=int)  # unassigned nodes to the offspring
+    remaining = _RemainingSet(ilen)  # unassigned nodes to the offspring, city c at position c - 1
     while True:
         off[i] = x
         i += 1
         if i >= ilen:
             break
-        remaining[x - 1] = 0
-        nlists[nlists == x] = -1  # removing x from neighbours lists
-        if np.any(nlists[x] != -1):
-            # neighbours of x and their neighbours count
-            x_neighbours_counts = [(n, len(nlists[n][nlists[n] != -1])) for n in nlists[x][nlists[x] != -1]]
-            # neighbours of x with fewest neighbours, there can be more than one
-            _, x_neighbours_counts_min_neighbourhood = next(itertools.groupby(sorted(x_neighbours_counts, key=itemgetter(1))))
-            # choose a neighbour of x with fewest neighbours randomly
-            x = np.random.choice([n[0] for n in x_neighbours_counts_min_neighbourhood])
+        remaining.remove(x - 1)
+        # removing x from neighbours lists, x only appears in the lists of its own neighbours
+        x_neighbours = [n for n in nlists[x] if n != -1]
+        for n in x_neighbours:
+            row = nlists[n]
+            for k in range(4):
+                if row[k] == x:
+                    row[k] = -1
+                    counts[n] -= 1
+        if x_neighbours:
+            # first neighbour of x with fewest neighbours
+            x = min(x_neighbours, key=lambda n: counts[n])
         else:
-            x = _choose_set_pos(remaining) + 1
+            x = remaining.nearest(np.random.randint(ilen)) + 1
     assert len(off) == len(set(off))  # sanity check
-    for i in range(ilen):
-        ind1[i] = off[i]
-        ind2[i] = off[i]
+    np.frombuffer(ind1, dtype=np.int32)[:] = off
+    np.frombuffer(ind2, dtype=np.int32)[:] = off
     return ind1, ind2
+
+
+def _connected_components(num_nodes, u, v):
+    """
+    Labels the connected components of the graph with edges (u[i], v[i]) by min-label propagation with pointer
+    jumping; every node is labelled with the smallest node of its component.
+    """
+    label = np.arange(num_nodes)
+    while True:
+        lu, lv = label[u], label[v]
+        low = np.minimum(lu, lv)
+        np.minimum.at(label, lu, low)
+        np.minimum.at(label, lv, low)
+        while True:
+            jumped = label[label]
+            if np.array_equal(jumped, label):
+                break
+            label = jumped
+        if np.array_equal(label[u], label[v]):
+            return label
+
+
+class PartitionCrossover(object):
+    """
+    Generalized partition crossover (GPX). The union graph of both parents minus their common edges falls apart
+    into components; a component entered and left through exactly two common edges is traversed by both parents as a
+    single path between the same two cities, so either parent's path can be used for it. Each offspring inherits,
+    for every such component, the shorter of the two paths, and everything else from one of the parents: the first
+    offspring is based on the first parent, the second one on the second parent. Runs in near linear time.
+    Path lengths are compared by plain euclidean distance, the prime penalty is left to the evaluation.
+    """
+    def __init__(self, tsp_instance):
+        self.cities = tsp_instance.cities
+
+    def __dist(self, a, b):
+        return np.sqrt(np.sum(np.square(self.cities[b] - self.cities[a]), axis=-1))
+
+    @staticmethod
+    def __adjacency(ind):
+        tour = np.concatenate(([0], np.asarray(ind, dtype=np.int64)))
+        succ, pred = np.empty_like(tour), np.empty_like(tour)
+        succ[tour] = np.roll(tour, -1)
+        pred[tour] = np.roll(tour, 1)
+        return succ, pred
+
+    @staticmethod
+    def __offspring(succ, pred, num_cities):
+        """Walks the tour given by the neighbours of every city, starting from city 0 towards succ[0]."""
+        off = np.empty(num_cities - 1, dtype=np.int64)
+        succ, pred = succ.tolist(), pred.tolist()
+        prev, cur = 0, succ[0]
+        for i in range(num_cities - 1):
+            off[i] = cur
+            prev, cur = cur, succ[cur] if succ[cur] != prev else pred[cur]
+        return off if cur == 0 else None
+
+    def __call__(self, ind1, ind2):
+        succ1, pred1 = self.__adjacency(ind1)
+        succ2, pred2 = self.__adjacency(ind2)
+        n, cities = len(succ1), np.arange(len(succ1))
+        # edge (c, succ[c]) of a parent is common if the other parent has it in either direction
+        common1 = (succ2 == succ1) | (pred2 == succ1)
+        common2 = (succ1 == succ2) | (pred1 == succ2)
+        u = np.concatenate((cities[~common1], cities[~common2]))
+        v = np.concatenate((succ1[~common1], succ2[~common2]))
+        if len(u) == 0:
+            return ind1, ind2  # identical tours
+        label = _connected_components(n, u, v)
+        label[np.bincount(np.concatenate((u, v)), minlength=n) == 0] = -1  # cities with only common edges
+        # count the common edges entering or leaving every component
+        a, b = cities[common1], succ1[common1]
+        crossing = label[a] != label[b]
+        ends = np.concatenate((label[a][crossing], label[b][crossing]))
+        portals = np.bincount(ends[ends > -1], minlength=n)
+        feasible = portals == 2
+        # length of the paths of both parents inside every component
+        len1 = np.bincount(label[~common1], weights=self.__dist(cities[~common1], succ1[~common1]), minlength=n)
+        len2 = np.bincount(label[~common2], weights=self.__dist(cities[~common2], succ2[~common2]), minlength=n)
+        offspring = []
+        for (succ_base, pred_base, len_base), (succ_other, pred_other, len_other) in \
+                (((succ1, pred1, len1), (succ2, pred2, len2)), ((succ2, pred2, len2), (succ1, pred1, len1))):
+            take_other = feasible & (len_other < len_base)
+            use_other = np.zeros(n, dtype=bool)
+            use_other[label > -1] = take_other[label[label > -1]]
+            succ = np.where(use_other, succ_other, succ_base)
+            pred = np.where(use_other, pred_other, pred_base)
+            off = self.__offspring(succ, pred, n)
+            offspring.append(off)
+        for ind, off in zip((ind1, ind2), offspring):
+            if off is not None:  # never expected, keep the parent if the offspring is not a single tour
+                np.frombuffer(ind, dtype=np.int32)[:] = off
+        return ind1, ind2
@@ -0,0 +1,162 @@
+import time
+import queue
+import logging
+import itertools
+import collections
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from . import worker
+from .population import individual_from
+from .messaging import TYPE, EVALUATE, WINDOW, ID, FIRST, SECOND
+
+Log = logging.getLogger(__name__)
+
+
+def _run_shared_task(task, shm_name, rows, num_cities):
+    """
+    Processes a task whose tours are rows of a shared memory matrix and writes the offspring over them.
+    Runs in the processes of the pool, which inherit the toolbox of the worker module.
+    :return: Tuple (start time, seconds spent in the operators, the result without the offspring tours)
+    """
+    started = time.time()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # attaching registers the block for cleanup at exit, but the executor owns it and unlinks it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    tours = np.ndarray((len(shm.buf) // (4 * (num_cities - 1)), num_cities - 1), dtype=np.int32, buffer=shm.buf)
+    try:
+        for key, row in rows.items():
+            task[key] = individual_from(tours[row])
+        st = time.perf_counter()
+        result = worker._process_task(task, worker._toolbox)
+        elapsed = time.perf_counter() - st
+        for key, row in rows.items():
+            if key in result:
+                tours[row] = np.frombuffer(result.pop(key), dtype=np.int32)
+    finally:
+        del tours
+        shm.close()
+    return started, elapsed, result
+
+
+class _SharedBatch(object):
+    """Shared memory block holding the tours of the tasks submitted together."""
+    def __init__(self, num_tours, num_cities):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, 4 * num_tours * (num_cities - 1)))
+        self.tours = np.ndarray((num_tours, num_cities - 1), dtype=np.int32, buffer=self.shm.buf)
+        self.pending = 0
+
+    def release(self):
+        del self.tours
+        self.shm.close()
+        self.shm.unlink()
+
+
+class LocalTaskExecutor(object):
+    """
+    Executes the tasks in processes of this machine instead of publishing them to the broker. Has the interface of
+    TaskPublisher, so the algorithms run unchanged. The tours are passed to the processes in shared memory, the
+    processes run the worker's task handling and write the offspring back in place. Like with TaskPublisher, every
+    call gets the results of its own tasks only.
+    """
+    def __init__(self, tsp_instance, processes=None, task_recorder=None):
+        self.num_cities = tsp_instance.size()
+        self.task_recorder = task_recorder
+        self.processes = processes or worker.WORKER_PROCESSES
+        # the forked processes inherit the toolbox, like the processes of a worker
+        worker._toolbox = worker.create_toolbox(tsp_instance)
+        Log.info('Starting %d local worker processes...' % self.processes)
+        self.pool = multiprocessing.get_context('fork').Pool(self.processes, initializer=worker._init_process)
+        self.done = queue.Queue()
+        self.ready = collections.defaultdict(collections.deque)  # stream -> (result, error)
+        self.pending = collections.Counter()  # stream -> number of pending tasks
+        self.stream_ids = itertools.count(1)
+
+    def __task_done_func(self, stream, batch, task_id, rows):
+        published = time.time()
+
+        def task_done(outcome):
+            started, operator, result = outcome
+            if self.task_recorder is not None:
+                self.task_recorder.record(worker='local', tasks=1, published=published, queue_wait=started - published,
+                                          operator=operator, total=time.time() - published)
+            self.done.put((stream, batch, task_id, rows, result, None))
+
+        def task_failed(e):
+            self.done.put((stream, batch, task_id, rows, None, e))
+        return task_done, task_failed
+
+    def submit(self, tasks_specs, stream=None):
+        """
+        Starts the tasks without waiting for their results.
+        :param tasks_specs: List of task specifications
+        :param stream: Stream the results are handed out to, None for the stream of results()
+        """
+        tasks_specs = list(tasks_specs)
+        if not tasks_specs:
+            return
+        # windows are shorter than tours, they are passed with the task
+        shared = [s[TYPE] != WINDOW for s in tasks_specs]
+        batch = _SharedBatch(sum(k in s for s, sh in zip(tasks_specs, shared) for k in (FIRST, SECOND) if sh),
+                             self.num_cities)
+        row = 0
+        for task_spec, in_shared_memory in zip(tasks_specs, shared):
+            task = {k: v for k, v in task_spec.items()
+                    if k != ID and (k not in (FIRST, SECOND) or not in_shared_memory)}
+            rows = {}
+            for key in (FIRST, SECOND):
+                if key in task_spec and in_shared_memory:
+                    batch.tours[row] = np.frombuffer(task_spec[key], dtype=np.int32)
+                    rows[key] = row
+                    row += 1
+            # evaluation tasks return no tours
+            done, failed = self.__task_done_func(stream, batch, task_spec.get(ID),
+                                                 rows if task[TYPE] != EVALUATE else {})
+            self.pool.apply_async(_run_shared_task, (task, batch.shm.name, rows, self.num_cities),
+                                  callback=done, error_callback=failed)
+            batch.pending += 1
+            self.pending[stream] += 1
+
+    def __collect(self):
+        """Waits for the next finished task and hands its result out to its stream."""
+        stream, batch, task_id, rows, scalars, error = self.done.get()
+        self.pending[stream] -= 1
+        batch.pending -= 1
+        result = {ID: task_id}
+        if scalars is not None:
+            result.update(scalars)
+        for key, row in rows.items():
+            result[key] = batch.tours[row].copy()
+        if not batch.pending:
+            batch.release()
+        self.ready[stream].append((result, error))
+
+    def results(self, stream=None):
+        """
+        Yields the results of the submitted tasks in order of completion, until none of them is pending. Tasks
+        submitted while iterating are waited for as well.
+        """
+        ready = self.ready[stream]
+        while ready or self.pending[stream]:
+            if not ready:
+                self.__collect()
+                continue
+            result, error = ready.popleft()
+            if error is not None:
+                Log.error('Task %s failed: %s' % (result[ID], error))
+                raise error
+            yield result
+        if stream is not None:
+            del self.ready[stream], self.pending[stream]
+
+    def __call__(self, tasks_specs):
+        """
+        Starts the tasks and returns an iterator over their results in order of completion.
+        """
+        stream = next(self.stream_ids)
+        self.submit(tasks_specs, stream)
+        return self.results(stream)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
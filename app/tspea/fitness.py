@@ -1,53 +1,145 @@
+import os
+import math
+import bisect
+import uuid
+import hashlib
+import logging
 import numpy as np
 import pandas as pd
+from .spatial import nearest_neighbours
+from .moves import REVERSE, SWAP, MOVE_SEGMENT, MOVE_SEGMENT_REVERSED, apply_move
+
+Log = logging.getLogger(__name__)
+
+_EVAL_BLOCK_SIZE = 1 << 22
+# moves after which TourCosts recomputes its prefix sums as a whole instead of shifting them
+_MAX_SHIFTS = 64
+# columns of the shifts: the distances, then the 10 classes of forward and of backward penalties
+_DIST, _FWD, _REV = 0, 1, 11
 
 
 class TSPInstance(object):
+    """
+    Cities of the problem with their prime mask. The parsed arrays and the derived indexes are cached in a
+    directory next to the cities file, keyed by the hash of its content; later starts memory-map the cache, so
+    processes on the same node share one copy of the data.
+    """
     def __init__(self, cities_file):
-        with open(cities_file) as f:
-            cities_df = pd.read_csv(f, sep=',', index_col=0)
-            self.num_cities = len(cities_df)
-            self.cities = np.empty((self.num_cities, 2), dtype=np.float64)
-            for i in cities_df.index.values:
-                self.cities[i, 0] = cities_df.loc[i, 'X']
-                self.cities[i, 1] = cities_df.loc[i, 'Y']
-            self.primes = set([p for p in self.__primes_sieve(self.num_cities)])
+        self.cities_file = cities_file
+        with open(cities_file, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self.cache_dir = os.path.join('%s.cache' % cities_file, digest[:16])
+        cities_cache = os.path.join(self.cache_dir, 'cities.npy')
+        primes_cache = os.path.join(self.cache_dir, 'is_prime.npy')
+        if os.path.exists(cities_cache) and os.path.exists(primes_cache):
+            Log.info('Loading cached instance from %s...' % self.cache_dir)
+            self.cities = np.load(cities_cache, mmap_mode='r')
+            self.is_prime = np.load(primes_cache, mmap_mode='r')
+        else:
+            with open(cities_file) as f:
+                cities_df = pd.read_csv(f, sep=',', index_col=0)
+            self.cities = np.empty((len(cities_df), 2), dtype=np.float64)
+            self.cities[cities_df.index.values] = cities_df[['X', 'Y']].to_numpy(dtype=np.float64)
+            self.is_prime = self.__primes_sieve(len(self.cities))
+            self.__save_cache(cities_cache, self.cities)
+            self.__save_cache(primes_cache, self.is_prime)
+        self.num_cities = len(self.cities)
 
     @staticmethod
     def __primes_sieve(limit):
-        a = [True] * limit  # Initialize the primality list
-        a[0] = a[1] = False
-        for (i, is_prime) in enumerate(a):
-            if is_prime:
-                yield i
-                for n in range(i * i, limit, i):  # Mark factors non-prime
-                    a[n] = False
+        is_prime = np.ones(limit, dtype=bool)  # Initialize the primality mask
+        is_prime[:2] = False
+        for i in range(2, int(math.sqrt(limit)) + 1):
+            if is_prime[i]:
+                is_prime[i * i::i] = False  # Mark factors non-prime
+        return is_prime
+
+    def __save_cache(self, cache_file, arr):
+        tmp_file = '%s.%s.tmp' % (cache_file, uuid.uuid4())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            Log.warning('Unable to cache %s: %s' % (cache_file, e))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
 
     def distance(self, start, end):
         return np.sqrt(np.sum(np.square(self.cities[end] - self.cities[start])))
 
     def step_distance(self, start, end, step_number):
         d = self.distance(start, end)
-        if step_number % 10 == 0 and start not in self.primes:
+        if step_number % 10 == 0 and not self.is_prime[start]:
             d += 0.1 * d
         return d
 
     def size(self):
         return self.num_cities
 
+    def nearest_neighbours(self, k):
+        """
+        Candidate lists of the k nearest neighbours of every city, shape (num_cities, k). The lists are stored in
+        the instance cache, so they are computed only once per instance.
+        """
+        cache_file = os.path.join(self.cache_dir, 'knn%d.npy' % k)
+        if os.path.exists(cache_file):
+            Log.info('Loading nearest neighbours from %s...' % cache_file)
+            return np.load(cache_file, mmap_mode='r')
+        Log.info('Computing %d nearest neighbours of every city...' % k)
+        nbours = nearest_neighbours(self.cities, k)
+        self.__save_cache(cache_file, nbours)
+        return nbours
+
 
 class EvalTSPSolution(object):
+    """
+    Vectorized evaluator of complete tours. A tour starts and ends at city 0, which is not part of the individual.
+    Every 10th step is 10% longer unless it starts from a prime city.
+    """
     def __init__(self, tsp_instance):
         self.tsp_instance = tsp_instance
+        self.is_prime = tsp_instance.is_prime
+
+    @staticmethod
+    def __paths(tours):
+        depot = np.zeros(tours.shape[:-1] + (1,), dtype=np.int64)
+        return np.concatenate((depot, tours, depot), axis=-1)
+
+    def lengths(self, tours):
+        """
+        Computes the lengths of one or more tours in a single pass.
+        :param tours: Individual or 2D array (one tour per row) of equally sized individuals
+        :return: Tour length, or numpy array of tour lengths
+        """
+        tours = np.asarray(tours)
+        if tours.ndim > 1 and tours.size > _EVAL_BLOCK_SIZE:
+            # bound the memory used by the gathered coordinates
+            rows = max(1, _EVAL_BLOCK_SIZE // tours.shape[-1])
+            return np.concatenate([self.lengths(tours[i:i + rows]) for i in range(0, len(tours), rows)])
+        paths = self.__paths(tours)
+        starts, ends = paths[..., :-1], paths[..., 1:]
+        coords = self.tsp_instance.cities
+        d = np.sqrt(np.sum(np.square(coords[ends] - coords[starts]), axis=-1))
+        steps = np.arange(1, paths.shape[-1])
+        penalized = (steps % 10 == 0) & ~self.is_prime[starts]
+        d[penalized] += 0.1 * d[penalized]
+        # sequential accumulation yields exactly the same sum as the step by step evaluation
+        return np.cumsum(d, axis=-1)[..., -1]
+
+    def batch(self, individuals):
+        """
+        Evaluates a whole population of equally sized individuals at once.
+        :param individuals: Sequence of individuals
+        :return: List of fitness tuples, one per individual
+        """
+        if not len(individuals):
+            return []
+        return [(float(l),) for l in self.lengths(np.stack([np.asarray(ind) for ind in individuals]))]
 
     def __call__(self, individual):
-        distance, prev, step_num = 0., 0, 1
-        for i in individual:
-            distance += self.tsp_instance.step_distance(prev, i, step_num)
-            prev = i
-            step_num += 1
-        distance += self.tsp_instance.step_distance(prev, 0, step_num)
-        return distance,
+        return float(self.lengths(individual)),
 
 
 class EvalTSPSolutionFragment(object):
@@ -68,3 +160,246 @@ class EvalTSPSolutionFragment(object):
                                                     0 if next_ind == len(individual) else individual[next_ind],
                                                     step_num + 1)
         return distance
+
+
+class FitnessSpotCheck(object):
+    """
+    Verifies a random share of the fitness values computed by the workers against an evaluation on the master.
+    Values which differ by more than the relative tolerance are logged and replaced.
+    """
+    def __init__(self, evaluate, probability, rel_tol=1e-6):
+        self.evaluate = evaluate
+        self.probability = probability
+        self.rel_tol = rel_tol
+        self.mismatches = 0
+
+    def __call__(self, individual, fitness):
+        if np.random.rand() >= self.probability:
+            return fitness
+        expected = self.evaluate(individual)[0]
+        if not math.isclose(fitness, expected, rel_tol=self.rel_tol):
+            self.mismatches += 1
+            Log.warning('Fitness %f returned by a worker differs from the evaluated %f' % (fitness, expected))
+        return expected
+
+
+class TourCosts(object):
+    """
+    Prefix sums of the edge costs of a tour, which allow evaluating in O(log s) (see below) how the tour length
+    changes when a part of it is reversed or two cities are swapped. Penalties are tracked per step-modulo-10 class and per direction,
+    so the prime penalty stays exact for edges which move to other steps or are traversed backwards.
+    Positions are the indexes of the individual. Edge j of the tour (j = 1..len(individual) + 1) is the j-th step,
+    it leaves the city at path position j - 1 where the path is the individual enclosed by city 0.
+    The position of every city is kept up to date in position, city 0 has position -1. The applied moves are recorded
+    in moves (see the moves module).
+    A window of a tour is handled the same way: the individual is then enclosed by the cities start and end, which
+    have position -1 as well, and edge j is step j + offset of the whole tour.
+    A move recomputes only the edges between its first and last changed positions. The prefix sums of the following
+    edges change by a constant per sum, which is recorded as a shift from that edge on instead of being added to
+    them, so a move costs O(m + log s) for m changed positions and s recorded shifts. The queries look the shifts
+    up in O(log s). After _MAX_SHIFTS moves all the prefix sums are recomputed in O(n).
+    """
+    def __init__(self, tsp_instance, individual, start=0, end=0, offset=0):
+        self.cities = tsp_instance.cities
+        self.non_prime = ~tsp_instance.is_prime
+        self.offset = offset
+        self.path = np.concatenate(([start], np.asarray(individual, dtype=np.int64), [end]))
+        nedges = len(self.path)
+        self.dist = np.zeros(nedges, dtype=np.float64)
+        self.cum_dist = np.zeros(nedges, dtype=np.float64)
+        # rows of 10 consecutive edges, so column r holds the edges whose step is r modulo 10
+        nrows = (nedges + 9) // 10
+        self.cum_fwd = np.zeros((nrows, 10), dtype=np.float64)
+        self.cum_rev = np.zeros((nrows, 10), dtype=np.float64)
+        # flat views, entry j belongs to edge j
+        self.fwd, self.rev = self.cum_fwd.reshape(-1), self.cum_rev.reshape(-1)
+        self.position = np.full(len(self.cities), -1, dtype=np.int64)
+        self.moves = []
+        self.__rebuild()
+
+    def __rebuild(self):
+        """Recomputes all the edges and prefix sums."""
+        path, n = self.path, len(self.path)
+        self.position[path[1:-1]] = np.arange(n - 2)
+        diff = self.cities[path[1:]] - self.cities[path[:-1]]
+        self.dist[1:] = np.sqrt(np.sum(np.square(diff), axis=-1))
+        self.cum_dist[:] = np.cumsum(self.dist)
+        fwd = np.zeros(self.fwd.size, dtype=np.float64)
+        rev = np.zeros(self.rev.size, dtype=np.float64)
+        fwd[1:n] = self.dist[1:] * self.non_prime[path[:-1]]
+        rev[1:n] = self.dist[1:] * self.non_prime[path[1:]]
+        self.cum_fwd[:] = np.cumsum(fwd.reshape(-1, 10), axis=0)
+        self.cum_rev[:] = np.cumsum(rev.reshape(-1, 10), axis=0)
+        # the stored prefix sums of the edges from shift_at[i] on lack row i + 1 of shift_sum, row 0 is zero
+        self.shift_at = []
+        self.shift_sum = np.zeros((1, 21), dtype=np.float64)
+
+    def __refresh(self, start, end):
+        """Recomputes the edges start..end + 1 after the path between start and end (inclusive) has changed."""
+        if len(self.shift_at) >= _MAX_SHIFTS:
+            self.__rebuild()
+            return
+        path, lo, hi = self.path, start, end + 1
+        self.position[path[start:end + 1]] = np.arange(start - 1, end)
+        before, old = self.__prefixes(lo - 1), self.__prefixes(hi)
+        diff = self.cities[path[lo:hi + 1]] - self.cities[path[lo - 1:hi]]
+        dist = self.dist[lo:hi + 1] = np.sqrt(np.sum(np.square(diff), axis=-1))
+        edges = np.arange(lo, hi + 1)
+        shifts = self.shift_sum[np.searchsorted(self.shift_at, edges, side='right')]
+        self.cum_dist[lo:hi + 1] = before[_DIST] + np.cumsum(dist) - shifts[:, _DIST]
+        # the prefix sums of each class, over rows of 10 edges
+        first = lo - lo % 10
+        classes = edges % 10
+        for cum, column, start_cities in ((self.fwd, _FWD, path[lo - 1:hi]), (self.rev, _REV, path[lo:hi + 1])):
+            block = np.zeros(hi - first + 10 - (hi - first) % 10, dtype=np.float64)
+            block[lo - first:hi - first + 1] = dist * self.non_prime[start_cities]
+            sums = np.cumsum(block.reshape(-1, 10), axis=0).reshape(-1)[lo - first:hi - first + 1]
+            cum[lo:hi + 1] = before[column + classes] + sums - shifts[np.arange(len(edges)), column + classes]
+        if hi + 1 < len(path):
+            self.__shift(hi + 1, self.__prefixes(hi) - old)
+
+    def __shift(self, j, delta):
+        """Records that the prefix sums of the edges from j on change by delta."""
+        i = bisect.bisect_left(self.shift_at, j)
+        if i == len(self.shift_at) or self.shift_at[i] != j:
+            self.shift_at.insert(i, j)
+            self.shift_sum = np.insert(self.shift_sum, i + 1, self.shift_sum[i], axis=0)
+        self.shift_sum[i + 1:] += delta
+
+    def __prefix(self, cum, column, j):
+        """Prefix sum of edge j in the given flat array and shift column."""
+        if not self.shift_at:
+            return cum[j]
+        return cum[j] + self.shift_sum[bisect.bisect_right(self.shift_at, j), column]
+
+    def __residue_prefix(self, cum, column, residue, j):
+        """Sum of the entries of the edges up to j whose index is congruent to residue modulo 10."""
+        if j < residue:
+            return 0.
+        return self.__prefix(cum, column + residue, j - (j - residue) % 10)
+
+    def __prefixes(self, j):
+        """All the prefix sums up to edge j, as a row of the shift columns."""
+        return np.array([self.__prefix(self.cum_dist, _DIST, j)] +
+                        [self.__residue_prefix(self.fwd, _FWD, r, j) for r in range(10)] +
+                        [self.__residue_prefix(self.rev, _REV, r, j) for r in range(10)])
+
+    def __residue_sum(self, cum, column, residue, lo, hi):
+        """Sum of the entries of edges lo..hi whose index is congruent to residue modulo 10."""
+        return self.__residue_prefix(cum, column, residue, hi) - self.__residue_prefix(cum, column, residue, lo - 1)
+
+    def distance(self, start, end):
+        x = self.cities[end, 0] - self.cities[start, 0]
+        y = self.cities[end, 1] - self.cities[start, 1]
+        return math.sqrt(x * x + y * y)
+
+    def step_cost(self, start, end, step_number):
+        d = self.distance(start, end)
+        if (step_number + self.offset) % 10 == 0 and self.non_prime[start]:
+            d += 0.1 * d
+        return d
+
+    def edges_cost(self, lo, hi, shift=0):
+        """
+        Cost of the edges lo..hi when each of them is traversed forward as step j + shift.
+        """
+        if lo > hi:
+            return 0.
+        penalty = self.__residue_sum(self.fwd, _FWD, (-shift - self.offset) % 10, lo, hi)
+        dist = self.__prefix(self.cum_dist, _DIST, hi) - self.__prefix(self.cum_dist, _DIST, lo - 1)
+        return dist + 0.1 * penalty
+
+    def reversed_edges_cost(self, lo, hi, pivot):
+        """
+        Cost of the edges lo..hi when each of them is traversed backwards as step pivot - j.
+        """
+        if lo > hi:
+            return 0.
+        penalty = self.__residue_sum(self.rev, _REV, (pivot + self.offset) % 10, lo, hi)
+        dist = self.__prefix(self.cum_dist, _DIST, hi) - self.__prefix(self.cum_dist, _DIST, lo - 1)
+        return dist + 0.1 * penalty
+
+    def length(self):
+        return self.edges_cost(1, len(self.path) - 1)
+
+    def reversal_delta(self, p1, p2):
+        """
+        Change of the tour length caused by reversing the individual between positions p1 and p2 (inclusive).
+        """
+        if p1 >= p2:
+            return 0.
+        path, a, b = self.path, p1 + 1, p2 + 1
+        new_cost = self.step_cost(path[a - 1], path[b], a) + \
+            self.reversed_edges_cost(a + 1, b, a + b + 1) + \
+            self.step_cost(path[a], path[b + 1], b + 1)
+        return new_cost - self.edges_cost(a, b + 1)
+
+    def swap_delta(self, p1, p2):
+        """
+        Change of the tour length caused by swapping the cities at positions p1 and p2 of the individual.
+        """
+        if p1 == p2:
+            return 0.
+        path, a, b = self.path, min(p1, p2) + 1, max(p1, p2) + 1
+        if b == a + 1:
+            new_cost = self.step_cost(path[a - 1], path[b], a) + \
+                self.step_cost(path[b], path[a], a + 1) + \
+                self.step_cost(path[a], path[b + 1], a + 2)
+            return new_cost - self.edges_cost(a, a + 2)
+        new_cost = self.step_cost(path[a - 1], path[b], a) + \
+            self.step_cost(path[b], path[a + 1], a + 1) + \
+            self.step_cost(path[b - 1], path[a], b) + \
+            self.step_cost(path[a], path[b + 1], b + 1)
+        return new_cost - self.edges_cost(a, a + 1) - self.edges_cost(b, b + 1)
+
+    def __apply(self, move):
+        changed = apply_move(self.path[1:-1], *move)
+        if changed is not None:
+            self.moves.append(move)
+            self.__refresh(changed[0] + 1, changed[1] + 1)
+
+    def reverse(self, p1, p2):
+        self.__apply((REVERSE, p1, p2, 0))
+
+    def swap(self, p1, p2):
+        self.__apply((SWAP, p1, p2, 0))
+
+    def __segment(self, a, b, reverse):
+        segment = self.path[a:b + 1]
+        return segment[::-1] if reverse else segment
+
+    def __chain_cost(self, cities, step):
+        """Cost of visiting the given cities in order, the first edge being the given step."""
+        return sum(self.step_cost(cities[i], cities[i + 1], step + i) for i in range(len(cities) - 1))
+
+    def segment_move_delta(self, s, e, q, reverse=False):
+        """
+        Change of the tour length caused by moving the cities at positions s..e (inclusive) of the individual between
+        the positions q and q + 1, optionally reversed; q = -1 inserts them right after city 0. Meant for short
+        segments (Or-opt), the cost of the segment itself is computed edge by edge.
+        """
+        path, a, b, c = self.path, s + 1, e + 1, q + 1
+        if a <= c <= b or c == a - 1:
+            return 0.
+        seg = self.__segment(a, b, reverse).tolist()
+        size = b - a + 1
+        if c > b:
+            new_cost = self.step_cost(path[a - 1], path[b + 1], a) + \
+                self.edges_cost(b + 2, c, -size) + \
+                self.__chain_cost([path[c]] + seg + [path[c + 1]], c - size + 1)
+            return new_cost - self.edges_cost(a, c + 1)
+        new_cost = self.__chain_cost([path[c]] + seg + [path[c + 1]], c + 1) + \
+            self.edges_cost(c + 2, a - 1, size) + \
+            self.step_cost(path[a - 1], path[b + 1], b + 1)
+        return new_cost - self.edges_cost(c + 1, b + 1)
+
+    def move_segment(self, s, e, q, reverse=False):
+        self.__apply((MOVE_SEGMENT_REVERSED if reverse else MOVE_SEGMENT, s, e, q))
+
+    def applied_moves(self):
+        """The applied moves as a flat int32 array of quadruples."""
+        return np.array(self.moves, dtype=np.int32).reshape(-1)
+
+    def tour(self):
+        """The current tour, without the enclosing city 0."""
+        return self.path[1:-1]
@@ -1,11 +1,20 @@
 import os
 import logging
+import functools
 import numpy as np
 from deap import base, tools
-from .fitness import TSPInstance, EvalTSPSolution, EvalTSPSolutionFragment
-from .population import init_population, save_population, save_best_individual
-from .messaging import publish_tasks, send_term_signals
-from .algorighms import ea_simple, write_stats, load_stats
+from .fitness import TSPInstance, EvalTSPSolution, EvalTSPSolutionFragment, FitnessSpotCheck
+from .mutation import PrimePenaltyOptimizer
+from .population import init_population, generate_population, checkpoint_generation, save_best_individual, \
+    CheckpointWriter
+from .messaging import TaskPublisher, Migrator, send_term_signals
+from .serialization import Codec
+from .tourhash import TourHash, FitnessCache
+from .executor import LocalTaskExecutor
+from .construction import HILBERT, NEAREST_NEIGHBOUR, GREEDY_EDGE
+from .algorighms import ea_simple, ea_steady_state, migrate, evaluate_remotely, construct_population, write_stats, \
+    load_stats, optimize_remotely, optimize_windows, BestOptimizer, save_optimized_best, GENERATION_PHASES
+from .telemetry import Metrics, Recorder, GenerationTimer, serve_metrics, TASK_FIELDS, TASKS_FNAME, GENERATIONS_FNAME
 
 Log = logging.getLogger(__name__)
 
@@ -13,21 +22,113 @@ POP_SIZE = int(os.getenv('POP_SIZE', 2))
 NUM_GENS = int(os.getenv('NUM_GENS', 2))
 CROSSOVER_PROB = float(os.getenv('CROSSOVER_PROB', .7))
 MUTATION_PROB = float(os.getenv('MUTATION_PROB', 1.0))
+TASK_ENCODING = os.getenv('TASK_ENCODING', 'binary')
+TASK_COMPRESSION = int(os.getenv('TASK_COMPRESSION', 0))
+TASK_BATCH_SIZE = int(os.getenv('TASK_BATCH_SIZE', 1))
+ALGORITHM = os.getenv('ALGORITHM', 'generational')
+TASKS_IN_FLIGHT = int(os.getenv('TASKS_IN_FLIGHT', POP_SIZE))
+REPORT_EVERY = int(os.getenv('REPORT_EVERY', POP_SIZE))
+REPLACEMENT = os.getenv('REPLACEMENT', 'worst')
+ISLAND_ID = os.getenv('ISLAND_ID', None)
+NUM_ISLANDS = int(os.getenv('NUM_ISLANDS', 1))
+MIGRATION_TOPOLOGY = os.getenv('MIGRATION_TOPOLOGY', 'ring')
+MIGRATION_INTERVAL = int(os.getenv('MIGRATION_INTERVAL', 10))
+NUM_MIGRANTS = int(os.getenv('NUM_MIGRANTS', 2))
+# shared by the islands of a run, the name of the output directory by default
+RUN_ID = os.getenv('RUN_ID', None)
+CHECKPOINT_EVERY = int(os.getenv('CHECKPOINT_EVERY', 1))
+METRICS_PORT = os.getenv('METRICS_PORT', None)
+FITNESS_CHECK_PROB = float(os.getenv('FITNESS_CHECK_PROB', 0.))
+FITNESS_CACHE_SIZE = int(os.getenv('FITNESS_CACHE_SIZE', 10000))
+DEDUPE = os.getenv('DEDUPE', 'false').lower() in ('1', 'true', 'yes')
+MUTATION_MOVES = os.getenv('MUTATION_MOVES', 'true').lower() in ('1', 'true', 'yes')
+TOUR_REF_RATIO = float(os.getenv('TOUR_REF_RATIO', 0.))
+TASK_TIMEOUT = os.getenv('TASK_TIMEOUT', None)
+DEADLINE_QUANTILE = float(os.getenv('DEADLINE_QUANTILE', 0.95))
+DEADLINE_FACTOR = float(os.getenv('DEADLINE_FACTOR', 3.))
+SKIP_LATE_MUTATIONS = os.getenv('SKIP_LATE_MUTATIONS', 'false').lower() in ('1', 'true', 'yes')
+OPTIMIZE_BEST = os.getenv('OPTIMIZE_BEST', 'none')
+PENALTY_OPT_TIME_LIMIT = float(os.getenv('PENALTY_OPT_TIME_LIMIT', 60.))
+OPTIMIZE_BEST_EVERY = int(os.getenv('OPTIMIZE_BEST_EVERY', 10))
+NUM_WINDOWS = int(os.getenv('NUM_WINDOWS', 16))
+NEAREST_NBOURS_SIZE = int(os.getenv('NEAREST_NBOURS_SIZE', 16))
+# shares of the initial population built by the construction heuristics, the rest is random
+INIT_RATIOS = {HILBERT: float(os.getenv('INIT_HILBERT', 0.)),
+               NEAREST_NEIGHBOUR: float(os.getenv('INIT_NN', 0.)),
+               GREEDY_EDGE: float(os.getenv('INIT_GREEDY', 0.))}
 
 
-def run(cities_file, broker_url, out_dir):
+def run(cities_file, broker_url, out_dir, backend='rabbitmq'):
     Log.info('Starting master...')
+    migrator = None
+    run_id = RUN_ID if RUN_ID is not None else os.path.basename(os.path.abspath(out_dir))
+    if ISLAND_ID is not None:
+        Log.info('Running island %s of %d' % (ISLAND_ID, NUM_ISLANDS))
+        out_dir = os.path.join(out_dir, 'island_%s' % ISLAND_ID)
+        os.makedirs(out_dir, exist_ok=True)
+    metrics = Metrics()
+    if METRICS_PORT is not None:
+        serve_metrics(int(METRICS_PORT), metrics)
+    task_recorder = Recorder(os.path.join(out_dir, TASKS_FNAME), TASK_FIELDS, 'task', metrics)
+    generation_recorder = Recorder(os.path.join(out_dir, GENERATIONS_FNAME), ['gen', 'total'] + GENERATION_PHASES,
+                                   'generation', metrics)
     toolbox = base.Toolbox()
     tsp_instance = TSPInstance(cities_file)
-    toolbox.register('evaluate', EvalTSPSolution(tsp_instance))
+    evaluator = EvalTSPSolution(tsp_instance)
+    toolbox.register('evaluate', evaluator)
+    toolbox.register('evaluate_population', evaluator.batch)
     toolbox.register('evaluate_fragment', EvalTSPSolutionFragment(tsp_instance))
     toolbox.register('select', tools.selTournament, tournsize=3)
-    toolbox.register('population', init_population, num_cities=tsp_instance.size(), in_dir=out_dir)
-    toolbox.register('publish_tasks', publish_tasks, broker_url=broker_url)
-    toolbox.register('save_population', save_population, out_dir=out_dir)
+    codec = Codec(binary=TASK_ENCODING == 'binary', compress_level=TASK_COMPRESSION)
+    tour_hash = TourHash(tsp_instance.size())
+    if backend == 'local':
+        publisher = LocalTaskExecutor(tsp_instance, task_recorder=task_recorder)
+    else:
+        publisher = TaskPublisher(broker_url, batch_size=TASK_BATCH_SIZE, codec=codec, task_recorder=task_recorder,
+                                  reply_moves=MUTATION_MOVES, tour_hash=tour_hash, tour_ref_ratio=TOUR_REF_RATIO,
+                                  task_timeout=float(TASK_TIMEOUT) if TASK_TIMEOUT is not None else None,
+                                  deadline_quantile=DEADLINE_QUANTILE, deadline_factor=DEADLINE_FACTOR,
+                                  skip_late_mutations=SKIP_LATE_MUTATIONS)
+    toolbox.register('publish_tasks', publisher)
+    toolbox.register('evaluate_remotely', evaluate_remotely, publish_tasks=publisher)
+    generate = generate_population
+    if any(ratio > 0 for ratio in INIT_RATIOS.values()):
+        generate = functools.partial(construct_population, ratios=INIT_RATIOS, publish_tasks=publisher)
+    toolbox.register('population', init_population, num_cities=tsp_instance.size(), in_dir=out_dir, generate=generate)
+    if FITNESS_CHECK_PROB > 0:
+        toolbox.register('check_fitness', FitnessSpotCheck(evaluator, FITNESS_CHECK_PROB))
+    fitness_cache = None
+    if FITNESS_CACHE_SIZE > 0:
+        fitness_cache = FitnessCache(FITNESS_CACHE_SIZE)
+        toolbox.register('tour_hash', tour_hash)
+        toolbox.register('cached_fitness', fitness_cache.get)
+        toolbox.register('cache_fitness', fitness_cache.put)
+    toolbox.register('submit_tasks', publisher.submit)
+    toolbox.register('task_results', publisher.results)
+    if ISLAND_ID is not None:
+        migrator = Migrator(broker_url, int(ISLAND_ID), NUM_ISLANDS, topology=MIGRATION_TOPOLOGY, codec=codec,
+                            run_id=run_id)
+        toolbox.register('migrate', migrate, migrator=migrator, interval=MIGRATION_INTERVAL,
+                         num_migrants=NUM_MIGRANTS)
+    checkpoint_writer = CheckpointWriter(out_dir, every=CHECKPOINT_EVERY)
+    toolbox.register('save_population', checkpoint_writer)
     toolbox.register('save_best_individual', save_best_individual, out_dir=out_dir)
+    best_optimizer = None
+    if OPTIMIZE_BEST == 'local':
+        optimizer = PrimePenaltyOptimizer(tsp_instance, tsp_instance.nearest_neighbours(NEAREST_NBOURS_SIZE))
+        optimize = functools.partial(optimizer, time_limit=PENALTY_OPT_TIME_LIMIT)
+    elif OPTIMIZE_BEST == 'remote':
+        optimize = functools.partial(optimize_remotely, publish_tasks=publisher)
+    elif OPTIMIZE_BEST == 'windows':
+        optimize = functools.partial(optimize_windows, publish_tasks=publisher, num_windows=NUM_WINDOWS)
+    elif OPTIMIZE_BEST != 'none':
+        raise ValueError('Unknown best individual optimization: %s' % OPTIMIZE_BEST)
+    if OPTIMIZE_BEST != 'none':
+        best_optimizer = BestOptimizer(optimize, every=OPTIMIZE_BEST_EVERY)
+        toolbox.register('save_best_individual', save_optimized_best, out_dir=out_dir, optimize_best=best_optimizer)
     toolbox.register('write_stats', write_stats, stats_file=os.path.join(out_dir, 'stats.csv'))
     toolbox.register('load_stats', load_stats, stats_file=os.path.join(out_dir, 'stats.csv'))
+    toolbox.register('generation_timer', GenerationTimer, GENERATION_PHASES, generation_recorder)
 
     hof = tools.HallOfFame(1)
     stats = tools.Statistics(lambda ind: ind.fitness.values)
@@ -37,9 +138,39 @@ def run(cities_file, broker_url, out_dir):
     stats.register("max", np.max)
 
     pop = toolbox.population(pop_size=POP_SIZE)
+    checkpoint_gen = checkpoint_generation(out_dir)
     try:
-        ea_simple(pop, toolbox, CROSSOVER_PROB, MUTATION_PROB, NUM_GENS, stats=stats, halloffame=hof)
-        send_term_signals(broker_url, retries=2)
+        if ALGORITHM == 'steady_state':
+            ea_steady_state(pop, toolbox, CROSSOVER_PROB, MUTATION_PROB, NUM_GENS * POP_SIZE, TASKS_IN_FLIGHT,
+                            REPORT_EVERY, stats=stats, halloffame=hof, replacement=REPLACEMENT,
+                            start_gen=checkpoint_gen + 1 if checkpoint_gen is not None else None, dedupe=DEDUPE)
+        else:
+            ea_simple(pop, toolbox, CROSSOVER_PROB, MUTATION_PROB, NUM_GENS, stats=stats, halloffame=hof,
+                      start_gen=checkpoint_gen + 1 if checkpoint_gen is not None else None, dedupe=DEDUPE)
+        if best_optimizer is not None:
+            best_optimizer(hof, force=True)
+        if migrator is not None:
+            # the workers are shared, the first island terminates them once all the islands finished
+            migrator.announce_finished()
+            if int(ISLAND_ID) == 0 and backend != 'local':
+                migrator.wait_for_islands()
+                send_term_signals(broker_url, retries=2)
+        elif backend != 'local':
+            send_term_signals(broker_url, retries=2)
     finally:
-        toolbox.save_best_individual(hof)
+        checkpoint_writer.close()
+        publisher.close()
+        task_recorder.close()
+        generation_recorder.close()
+        if fitness_cache is not None:
+            Log.info('Fitness cache: %d hits, %d misses' % (fitness_cache.hits, fitness_cache.misses))
+        if getattr(publisher, 'tour_misses', 0):
+            Log.info('Worker tour caches: %d messages published again' % publisher.tour_misses)
+        if getattr(publisher, 'duplicates', 0):
+            Log.info('Missed deadlines: %d copies published, %d late replies dropped, %d mutations skipped'
+                     % (publisher.duplicates, publisher.late_replies, publisher.skipped_tasks))
+        if migrator is not None:
+            migrator.close()
+        # the publisher is closed, the best individual was optimized once the algorithm finished
+        save_best_individual(hof, out_dir=out_dir)
 
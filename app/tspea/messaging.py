@@ -1,10 +1,16 @@
 import pika
 import uuid
-import json
+import itertools
+import random
+import collections
 import threading
 import time
 import logging
+import numpy as np
 from .utils import print_progress_bar
+from .serialization import Codec
+from .telemetry import RECEIVED_HEADER, REPLIED_HEADER, WORKER_HEADER, DECODE_HEADER, OPERATOR_HEADER, \
+    ENCODE_HEADER, from_header
 
 Log = logging.getLogger(__name__)
 
@@ -12,19 +18,54 @@ Log = logging.getLogger(__name__)
 TASK_QUEUE = 'task_queue'
 TERM_SIG_EXCHANGE = 'term_signal_exchange'
 TERM_QUEUE = 'term_queue'
+MIGRATION_EXCHANGE = 'migration_exchange'
+MIGRATION_QUEUE = 'migration_queue_%d'
+ISLAND_FINISHED = 'island_finished'
+ISLAND_FINISHED_QUEUE = 'island_finished_queue'
 TYPE = 'type'
 MATE = 'mate'
 MUTATE = 'mutate'
+MATE_MUTATE = 'mate_mutate'
+EVALUATE = 'evaluate'
+CONSTRUCT = 'construct'
+OPTIMIZE = 'optimize'
+WINDOW = 'window'
+START = 'start'
+END = 'end'
+OFFSET = 'offset'
+GAIN = 'gain'
+METHOD = 'method'
+SEED = 'seed'
+MUTATE_FIRST = 'm_1'
+MUTATE_SECOND = 'm_2'
+FITNESS_FIRST = 'f_1'
+FITNESS_SECOND = 'f_2'
+REPLY_MOVES = 'r_m'
+MOVES = 'moves'
+FIRST_REF = 'h_1'
+SECOND_REF = 'h_2'
+TOUR_MISS = 'miss'
+SKIPPED = 'skipped'
+ERROR = 'error'
 ID = 'id'
 FIRST = '_1'
 SECOND = '_2'
 GEN = 'gen'
+FITNESS = 'fitness'
+ISLAND = 'island'
 TERMINATE = 'terminate'
+_TOUR_KEYS = ((FIRST, FIRST_REF), (SECOND, SECOND_REF))
+# round trips observed before the deadlines follow their distribution
+_MIN_ROUND_TRIPS = 20
+_ROUND_TRIPS_WINDOW = 500
+# tasks running for their time limit by design, a copy would only double the work
+_NO_DEADLINE_TYPES = (OPTIMIZE, WINDOW)
 
 
 def declare_topology(channel):
     channel.queue_declare(queue=TASK_QUEUE, durable=True, exclusive=False, auto_delete=False)
     channel.exchange_declare(exchange=TERM_SIG_EXCHANGE, exchange_type='fanout')
+    channel.exchange_declare(exchange=MIGRATION_EXCHANGE, exchange_type='direct')
 
 
 def ack_message(channel, delivery_tag):
@@ -39,23 +80,87 @@ def ack_message(channel, delivery_tag):
         pass
 
 
-class _TaskPublisher(object):
+class TaskPublisher(object):
+    """
+    Long-lived task publisher. It keeps one connection and one exclusive reply queue for the whole run, blocks on
+    the connection while waiting for replies and hands out the results as soon as they arrive.
+    Every call gets the results of its own tasks only, the tasks of submit are returned by results, so a call can be
+    made while submitted tasks are in flight.
+    Messages whose replies are pending are published again if the connection has to be re-established.
+    With a tour hash and a positive tour_ref_ratio, tours travel along with their hash and the publisher keeps
+    track of the workers which replied to messages carrying them. Once the share of the known workers holding a
+    tour reaches the ratio, tasks reference it by its hash only. The workers cache the offspring they reply with as
+    well and return their hashes. A worker which misses a referenced tour replies with TOUR_MISS and the message is
+    published again with full tours. A worker which fails to process a message replies with an ERROR, which is
+    raised.
+    With a task timeout, messages get a deadline: the timeout until enough replies of messages of the same task
+    types arrived, then deadline_factor times the deadline_quantile of their recent round trips. Optimization and
+    window tasks get no deadline. A message past its deadline is published again, the
+    deadline doubling with every copy, and the first reply wins. Late duplicates are dropped. With
+    skip_late_mutations, a message of mutation tasks which misses the deadline of its second copy is given up on
+    and its tasks are returned as SKIPPED, so the offspring stay unmutated.
+    """
 
-    def __init__(self, broker_url, show_feedback=False):
+    def __init__(self, broker_url, show_feedback=False, batch_size=1, codec=None, poll_interval=1.,
+                 task_recorder=None, reply_moves=False, tour_hash=None, tour_ref_ratio=0., tracked_tours=10000,
+                 task_timeout=None, deadline_quantile=0.95, deadline_factor=3., skip_late_mutations=False):
+        self.broker_url = broker_url
+        self.task_timeout = task_timeout
+        self.deadline_quantile = deadline_quantile
+        self.deadline_factor = deadline_factor
+        self.skip_late_mutations = skip_late_mutations
+        # correlation id -> [first publish time, last publish time, copies, mutations only, task types]
+        self.dispatches = dict()
+        # task types of a message -> round trips
+        self.round_trips = collections.defaultdict(lambda: collections.deque(maxlen=_ROUND_TRIPS_WINDOW))
+        self.duplicates = 0
+        self.late_replies = 0
+        self.skipped_tasks = 0
+        self.reply_moves = reply_moves
+        self.tour_hash = tour_hash if tour_ref_ratio > 0 else None
+        self.tour_ref_ratio = tour_ref_ratio
+        self.tracked_tours = tracked_tours
+        self.tour_holders = collections.OrderedDict()  # tour hash -> names of the workers holding it
+        self.workers = set()
+        self.sent_tours = dict()  # correlation id -> (hashes of the full tours, hashes of the referenced tours)
+        self.tour_misses = 0
+        self.task_recorder = task_recorder
+        self.published = dict()  # correlation id -> publish time
         self.show_feedback = show_feedback
-        self.response = []
+        self.batch_size = max(1, batch_size)
+        self.codec = codec if codec is not None else Codec()
+        self.poll_interval = poll_interval
+        self.ready = collections.defaultdict(collections.deque)  # stream -> results
+        self.streams = dict()  # correlation id -> stream, the submitted tasks have stream None
+        self.stream_pending = collections.Counter()  # stream -> number of pending messages
+        self.stream_ids = itertools.count(1)
         self.num_processed_tasks = 0
-        self.pending_tasks = dict()
-        # setup channel
-        self.connection = pika.BlockingConnection(pika.URLParameters(broker_url))
+        self.pending_tasks = dict()  # correlation id -> (task ids, message body)
+        self.lock = threading.Lock()
+        self.connection = None
+        self.__connect()
+
+    def __connect(self):
+        self.connection = pika.BlockingConnection(pika.URLParameters(self.broker_url))
         self.channel = self.connection.channel()
         declare_topology(self.channel)
         result = self.channel.queue_declare(exclusive=True)  # response queue
         self.callback_queue = result.method.queue
         self.channel.basic_consume(self.__on_response, no_ack=True, queue=self.callback_queue)
-        self.lock = threading.Lock()
-        if self.show_feedback:
-            self.feedback_thread = threading.Thread(target=self.__print_progress)
+
+    def __ensure_connection(self):
+        if self.connection.is_open:
+            return
+        Log.warning('Connection to the broker lost, reconnecting...')
+        self.__connect()
+        # replies to the old reply queue are lost, publish the pending messages again
+        for corr_id, (_, body) in self.pending_tasks.items():
+            if corr_id in self.sent_tours:
+                self.sent_tours[corr_id] = self.__full_tours(body), ()
+            self.__publish(corr_id, body)
+
+    def __num_pending_tasks(self):
+        return sum(len(ids) for ids, _ in self.pending_tasks.values())
 
     def __print_progress(self):
         while len(self.pending_tasks) > 0:
@@ -63,65 +168,367 @@ class _TaskPublisher(object):
             self.lock.acquire()
             try:
                 iteration = self.num_processed_tasks
-                total = self.num_processed_tasks + len(self.pending_tasks);
+                total = self.num_processed_tasks + self.__num_pending_tasks()
             finally:
                 self.lock.release()
             print_progress_bar(iteration, total, prefix='Progress:', suffix='Complete', bar_length=50)
 
+    def __record_timings(self, corr_id, num_tasks, props, received, reply_decode):
+        published = self.published.pop(corr_id, None)
+        if self.task_recorder is None or published is None:
+            return
+        headers = props.headers or {}
+        worker = headers.get(WORKER_HEADER)
+        timings = dict(corr_id=corr_id, worker=worker.decode() if isinstance(worker, bytes) else worker,
+                       tasks=num_tasks, published=published, decode=from_header(headers.get(DECODE_HEADER)),
+                       operator=from_header(headers.get(OPERATOR_HEADER)),
+                       encode=from_header(headers.get(ENCODE_HEADER)), reply_decode=reply_decode,
+                       total=received - published)
+        if RECEIVED_HEADER in headers:
+            timings['queue_wait'] = from_header(headers[RECEIVED_HEADER]) - published
+        if REPLIED_HEADER in headers:
+            timings['reply_latency'] = received - from_header(headers[REPLIED_HEADER])
+        self.task_recorder.record(**timings)
+
+    def __holders(self, tour_hash):
+        holders = self.tour_holders.get(tour_hash)
+        if holders is None:
+            holders = self.tour_holders[tour_hash] = set()
+            if len(self.tour_holders) > self.tracked_tours:
+                self.tour_holders.popitem(last=False)
+        else:
+            self.tour_holders.move_to_end(tour_hash)
+        return holders
+
+    def __track_tours(self, corr_id, props, results, missed):
+        sent, referenced = self.sent_tours.pop(corr_id, ((), ()))
+        # hashes of the offspring cached by the worker
+        replied = [r.pop(ref) for r in results for _, ref in _TOUR_KEYS if ref in r]
+        worker = (props.headers or {}).get(WORKER_HEADER)
+        if worker is None:
+            return
+        worker = worker.decode() if isinstance(worker, bytes) else worker
+        self.workers.add(worker)
+        for tour_hash in list(sent) + replied:
+            self.__holders(tour_hash).add(worker)
+        for tour_hash in referenced:
+            if missed:
+                self.__holders(tour_hash).discard(worker)
+            else:
+                self.__holders(tour_hash).add(worker)
+
     def __on_response(self, ch, method, props, body):
         if props.correlation_id in self.pending_tasks:
-                task_id = self.pending_tasks[props.correlation_id]
-                r = json.loads(body.decode('utf-8'))
-                task_result = {ID: task_id}
-                if FIRST in r:
-                    task_result[FIRST] = r[FIRST]
-                if SECOND in r:
-                    task_result[SECOND] = r[SECOND]
-                self.lock.acquire()
-                try:
-                    del self.pending_tasks[props.correlation_id]
-                    self.num_processed_tasks += 1
-                finally:
-                    self.lock.release()
-                self.response.append(task_result)
+                received = time.time()
+                task_ids, full_body = self.pending_tasks[props.correlation_id]
+                results, _ = Codec.decode(body)
+                errors = [r[ERROR] for r in results if ERROR in r]
+                if errors:
+                    raise RuntimeError('Message %s failed on the worker: %s' % (props.correlation_id, errors[0]))
+                missed = any(r.get(TOUR_MISS) for r in results)
+                self.__track_tours(props.correlation_id, props, results, missed)
+                if missed:
+                    # the worker does not hold a referenced tour, publish the tours themselves
+                    self.tour_misses += 1
+                    self.sent_tours[props.correlation_id] = self.__full_tours(full_body), ()
+                    self.__publish(props.correlation_id, full_body)
+                    return
+                dispatch = self.dispatches.pop(props.correlation_id)
+                self.round_trips[dispatch[4]].append(received - dispatch[0])
+                self.__record_timings(props.correlation_id, len(task_ids), props, received, time.time() - received)
+                self.__complete(props.correlation_id, results)
+        else:
+            # the reply to a copy of a message which was already answered
+            self.late_replies += 1
+
+    def __deadline(self, copies, task_types):
+        if any(task_type in _NO_DEADLINE_TYPES for task_type in task_types):
+            return float('inf')
+        round_trips = self.round_trips[task_types]
+        if len(round_trips) < _MIN_ROUND_TRIPS:
+            deadline = self.task_timeout
+        else:
+            quantile = float(np.quantile(round_trips, self.deadline_quantile))
+            deadline = max(self.poll_interval, self.deadline_factor * quantile)
+        return deadline * 2 ** (copies - 1)
+
+    def __complete(self, corr_id, results):
+        """Hands the results of a message out to the stream of its tasks."""
+        task_ids, _ = self.pending_tasks[corr_id]
+        stream = self.streams.pop(corr_id)
+        for task_id, r in zip(task_ids, results):
+            task_result = dict(r)
+            task_result[ID] = task_id
+            self.ready[stream].append(task_result)
+        self.stream_pending[stream] -= 1
+        self.lock.acquire()
+        try:
+            del self.pending_tasks[corr_id]
+            self.num_processed_tasks += len(task_ids)
+        finally:
+            self.lock.release()
+
+    def __skip(self, corr_id):
+        task_ids, _ = self.pending_tasks[corr_id]
+        self.dispatches.pop(corr_id)
+        self.published.pop(corr_id, None)
+        self.sent_tours.pop(corr_id, None)
+        self.skipped_tasks += len(task_ids)
+        self.__complete(corr_id, [{SKIPPED: True}] * len(task_ids))
+
+    def __check_deadlines(self):
+        """
+        Publishes a copy of the messages past their deadline, or skips them (see skip_late_mutations).
+        """
+        if self.task_timeout is None:
+            return
+        now = time.time()
+        for corr_id in list(self.pending_tasks):
+            dispatch = self.dispatches[corr_id]
+            _, last_published, copies, mutations_only, task_types = dispatch
+            if now - last_published < self.__deadline(copies, task_types):
+                continue
+            if self.skip_late_mutations and mutations_only and copies > 1:
+                Log.warning('Message %s missed its deadline %d times, skipping its mutations' % (corr_id, copies))
+                self.__skip(corr_id)
+                continue
+            Log.warning('Message %s missed its deadline, publishing a copy' % corr_id)
+            _, body = self.pending_tasks[corr_id]
+            if corr_id in self.sent_tours:
+                self.sent_tours[corr_id] = self.__full_tours(body), ()
+            self.__publish(corr_id, body)
+            dispatch[1], dispatch[2] = now, copies + 1
+            self.duplicates += 1
 
     @staticmethod
-    def __task_from(task_spec):
+    def __full_tours(body):
+        tasks, _ = Codec.decode(body)
+        return [task[ref] for task in tasks for _, ref in _TOUR_KEYS if ref in task]
+
+    def __references(self, task):
+        """
+        Adds the hashes of the tours to the task and returns a copy of it in which the tours held by enough workers
+        are replaced by their hashes.
+        """
+        referenced = dict(task)
+        if task[TYPE] == WINDOW:
+            # windows are sent once
+            return referenced
+        for key, ref in _TOUR_KEYS:
+            if key not in task:
+                continue
+            task[ref] = referenced[ref] = self.tour_hash(task[key])
+            holders = self.tour_holders.get(task[ref], ())
+            if self.workers and len(holders) >= self.tour_ref_ratio * len(self.workers):
+                del referenced[key]
+        return referenced
+
+    def __encode(self, corr_id, tasks):
+        """
+        Encodes the tasks of a message.
+        :return: Tuple (full body, body to publish), the tours may be referenced by their hashes in the latter
+        """
+        if self.tour_hash is None:
+            body = self.codec.encode(tasks)
+            return body, body
+        referenced = [self.__references(task) for task in tasks]
+        sent = [t[ref] for t in referenced for key, ref in _TOUR_KEYS if key in t and ref in t]
+        refs = [t[ref] for t in referenced for key, ref in _TOUR_KEYS if ref in t and key not in t]
+        if sent or refs:
+            self.sent_tours[corr_id] = sent, refs
+        body = self.codec.encode(tasks)
+        return body, self.codec.encode(referenced) if refs else body
+
+    def __task_from(self, task_spec):
         task = {TYPE: task_spec[TYPE]}
-        if task_spec[TYPE] in [MATE, MUTATE]:
+        if task_spec[TYPE] in [MUTATE, OPTIMIZE] and self.reply_moves:
+            # the mutated tour is kept by the caller, the moves which mutate it suffice
+            task[REPLY_MOVES] = True
+        if task_spec[TYPE] in [MATE, MUTATE, MATE_MUTATE, EVALUATE, OPTIMIZE, WINDOW]:
             task[GEN] = task_spec[GEN]
             task[FIRST] = task_spec[FIRST]
-        if task_spec[TYPE] == MATE:
+        if task_spec[TYPE] in [MATE, MATE_MUTATE]:
             task[SECOND] = task_spec[SECOND]
+        if task_spec[TYPE] == MATE_MUTATE:
+            task[MUTATE_FIRST] = task_spec[MUTATE_FIRST]
+            task[MUTATE_SECOND] = task_spec[MUTATE_SECOND]
+        if task_spec[TYPE] == CONSTRUCT:
+            task[GEN] = task_spec[GEN]
+            task[METHOD] = task_spec[METHOD]
+            task[SEED] = task_spec[SEED]
+        if task_spec[TYPE] == WINDOW:
+            task[START] = task_spec[START]
+            task[END] = task_spec[END]
+            task[OFFSET] = task_spec[OFFSET]
         return task
 
-    def __call__(self, tasks_specs):
-        for task_spec in tasks_specs:
+    def __publish(self, corr_id, body):
+        self.channel.basic_publish(exchange='',
+                                   routing_key=TASK_QUEUE,
+                                   properties=pika.BasicProperties(
+                                       reply_to=self.callback_queue,
+                                       correlation_id=corr_id,
+                                       delivery_mode=2
+                                   ),
+                                   body=body)
+
+    def submit(self, tasks_specs, stream=None):
+        """
+        Publishes the tasks without waiting for their results.
+        :param tasks_specs: List of task specifications
+        :param stream: Stream the results are handed out to, None for the stream of results()
+        """
+        self.__ensure_connection()
+        # several tasks can travel in one message, their results come back in one reply
+        for b in range(0, len(tasks_specs), self.batch_size):
+            batch = tasks_specs[b:b + self.batch_size]
             corr_id = str(uuid.uuid4())
-            task = self.__task_from(task_spec)
-            self.channel.basic_publish(exchange='',
-                                       routing_key=TASK_QUEUE,
-                                       properties=pika.BasicProperties(
-                                           reply_to=self.callback_queue,
-                                           correlation_id=corr_id,
-                                           delivery_mode=2
-                                       ),
-                                       body=json.dumps(task))
-            if task_spec[TYPE] != TERMINATE:
-                self.pending_tasks[corr_id] = task_spec[ID]
-        if self.show_feedback:
-            self.feedback_thread.start()
-        while len(self.pending_tasks) != 0:
-            self.connection.process_data_events()
+            body, published_body = self.__encode(corr_id, [self.__task_from(s) for s in batch])
+            self.__publish(corr_id, published_body)
+            if any(task_spec[TYPE] != TERMINATE for task_spec in batch):
+                # the full body is kept, it is published again after a tour cache miss, a missed deadline or a
+                # reconnection
+                self.pending_tasks[corr_id] = ([task_spec.get(ID) for task_spec in batch], body)
+                self.streams[corr_id] = stream
+                self.stream_pending[stream] += 1
+                self.published[corr_id] = time.time()
+                self.dispatches[corr_id] = [self.published[corr_id], self.published[corr_id], 1,
+                                            all(task_spec[TYPE] == MUTATE for task_spec in batch),
+                                            tuple(sorted({task_spec[TYPE] for task_spec in batch}))]
+
+    def results(self, stream=None):
+        """
+        Yields the results of the submitted tasks in order of arrival, until none of them is pending. Tasks submitted
+        while iterating are waited for as well.
+        """
+        ready = self.ready[stream]
+        while True:
+            while ready:
+                yield ready.popleft()
+            if not self.stream_pending[stream]:
+                if stream is not None:
+                    del self.ready[stream], self.stream_pending[stream]
+                return
+            self.__ensure_connection()
+            # blocks until a reply arrives or the poll interval elapses
+            self.connection.process_data_events(time_limit=self.poll_interval)
+            self.__check_deadlines()
+
+    def __call__(self, tasks_specs):
+        """
+        Publishes the tasks and returns an iterator over their results in order of arrival.
+        """
+        stream = next(self.stream_ids)
+        self.submit(tasks_specs, stream)
         if self.show_feedback:
-            self.feedback_thread.join()
-        self.connection.close()
-        return self.response
+            threading.Thread(target=self.__print_progress, daemon=True).start()
+        return self.results(stream)
+
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+
+def publish_tasks(tasks, broker_url, batch_size=1, codec=None):
+    publisher = TaskPublisher(broker_url, batch_size=batch_size, codec=codec)
+    try:
+        return list(publisher(tasks))
+    finally:
+        publisher.close()
+
+
+class Migrator(object):
+    """
+    Exchanges migrants between the islands of an island model run over the migration exchange. Each island has a
+    durable queue bound with its id as routing key, so migrants sent to a restarting island are not lost.
+    The queue names and routing keys are prefixed with the id of the run, so that migrants and announcements left
+    over by other runs are not received.
+    Supported topologies: 'ring' sends to the next island, 'complete' to all other islands and 'random' to one
+    randomly chosen island.
+    """
+
+    def __init__(self, broker_url, island_id, num_islands, topology='ring', codec=None, run_id=''):
+        self.broker_url = broker_url
+        self.island_id = island_id
+        self.num_islands = num_islands
+        self.topology = topology
+        self.codec = codec if codec is not None else Codec()
+        self.prefix = '%s.' % run_id if run_id else ''
+        self.finished_queue = self.prefix + ISLAND_FINISHED_QUEUE
+        self.connection = None
+        self.__ensure_connection()
+
+    def __ensure_connection(self):
+        if self.connection is not None and self.connection.is_open:
+            return
+        self.connection = pika.BlockingConnection(pika.URLParameters(self.broker_url))
+        self.channel = self.connection.channel()
+        declare_topology(self.channel)
+        self.queue = self.prefix + MIGRATION_QUEUE % self.island_id
+        self.channel.queue_declare(queue=self.queue, durable=True, exclusive=False, auto_delete=False)
+        self.channel.queue_bind(exchange=MIGRATION_EXCHANGE, queue=self.queue,
+                                routing_key=self.__routing_key(self.island_id))
+        # the announcements only matter while the run goes on
+        self.channel.queue_declare(queue=self.finished_queue, durable=False, exclusive=False, auto_delete=False)
+        self.channel.queue_bind(exchange=MIGRATION_EXCHANGE, queue=self.finished_queue,
+                                routing_key=self.__routing_key(ISLAND_FINISHED))
+
+    def __routing_key(self, destination):
+        return self.prefix + str(destination)
+
+    def destinations(self):
+        others = [i for i in range(self.num_islands) if i != self.island_id]
+        if not others:
+            return []
+        if self.topology == 'complete':
+            return others
+        elif self.topology == 'random':
+            return [random.choice(others)]
+        return [(self.island_id + 1) % self.num_islands]
+
+    def emigrate(self, individuals):
+        self.__ensure_connection()
+        body = self.codec.encode([{ISLAND: self.island_id, FIRST: ind, FITNESS: ind.fitness.values[0]}
+                                  for ind in individuals])
+        for dest in self.destinations():
+            self.channel.basic_publish(exchange=MIGRATION_EXCHANGE, routing_key=self.__routing_key(dest), body=body,
+                                       properties=pika.BasicProperties(delivery_mode=2))
+
+    def immigrate(self):
+        """
+        Returns the migrants which arrived since the last call, without waiting for new ones.
+        """
+        self.__ensure_connection()
+        migrants = []
+        while True:
+            method, _, body = self.channel.basic_get(queue=self.queue, no_ack=True)
+            if method is None:
+                return migrants
+            messages, _ = Codec.decode(body)
+            migrants.extend(messages)
+
+    def announce_finished(self):
+        self.__ensure_connection()
+        self.channel.basic_publish(exchange=MIGRATION_EXCHANGE, routing_key=self.__routing_key(ISLAND_FINISHED),
+                                   body=str(self.island_id))
 
+    def wait_for_islands(self, poll_interval=5.):
+        """
+        Blocks until every other island announced that it finished.
+        """
+        finished = {self.island_id}
+        while len(finished) < self.num_islands:
+            self.__ensure_connection()
+            method, _, body = self.channel.basic_get(queue=self.finished_queue, no_ack=True)
+            if method is None:
+                self.connection.sleep(poll_interval)
+                continue
+            finished.add(int(body))
+            Log.info('Island %s finished (%d of %d)' % (body, len(finished), self.num_islands))
 
-def publish_tasks(tasks, broker_url):
-    publisher = _TaskPublisher(broker_url)
-    return publisher(tasks)
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
 
 
 def send_term_signals(broker_url, retries=1):
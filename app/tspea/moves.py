@@ -0,0 +1,67 @@
+"""
+Moves which change a tour in place. Mutation operators record the moves they apply, so that a tour can be turned into
+the offspring by whoever holds a copy of it, without sending the whole offspring. A move is a quadruple of integers
+(operation, a, b, c) on the positions of the individual:
+
+- REVERSE reverses the individual between positions a and b (inclusive)
+- SWAP swaps the cities at positions a and b
+- MOVE_SEGMENT moves the cities at positions a..b between the positions c and c + 1, MOVE_SEGMENT_REVERSED moves them
+  reversed; c = -1 moves them to the start of the individual
+"""
+import numpy as np
+
+REVERSE = 0
+SWAP = 1
+MOVE_SEGMENT = 2
+MOVE_SEGMENT_REVERSED = 3
+
+
+def _reverse(tour, p1, p2, _):
+    tour[p1:p2 + 1] = tour[p1:p2 + 1][::-1].copy()
+    return p1, p2
+
+
+def _swap(tour, p1, p2, _):
+    tour[p1], tour[p2] = tour[p2], tour[p1]
+    return min(p1, p2), max(p1, p2)
+
+
+def _move_segment(tour, s, e, q, reverse=False):
+    if s <= q <= e or q == s - 1:
+        return None
+    segment = tour[s:e + 1][::-1].copy() if reverse else tour[s:e + 1].copy()
+    size = e - s + 1
+    if q > e:
+        tour[s:q - size + 1] = tour[e + 1:q + 1].copy()
+        tour[q - size + 1:q + 1] = segment
+        return s, q
+    tour[q + 1 + size:e + 1] = tour[q + 1:s].copy()
+    tour[q + 1:q + 1 + size] = segment
+    return q + 1, e
+
+
+_OPERATIONS = {
+    REVERSE: _reverse,
+    SWAP: _swap,
+    MOVE_SEGMENT: _move_segment,
+    MOVE_SEGMENT_REVERSED: lambda tour, s, e, q: _move_segment(tour, s, e, q, reverse=True),
+}
+
+
+def apply_move(tour, operation, a, b, c):
+    """
+    Applies a move to a numpy array of the cities of an individual.
+    :return: Tuple (first, last) of the changed positions, None if the tour did not change
+    """
+    return _OPERATIONS[operation](tour, a, b, c)
+
+
+def apply_moves(tour, moves):
+    """
+    Applies the moves in order.
+    :param tour: Numpy array of the cities of an individual
+    :param moves: Moves as a flat sequence of quadruples
+    """
+    for operation, a, b, c in np.asarray(moves, dtype=np.int64).reshape(-1, 4).tolist():
+        apply_move(tour, operation, a, b, c)
+    return tour
@@ -1,4 +1,14 @@
+import time
+import logging
+import collections
 import numpy as np
+from .fitness import TourCosts
+from .moves import SWAP, MOVE_SEGMENT
+
+Log = logging.getLogger(__name__)
+
+# improvements below the rounding error of the prefix sums are ignored
+_MIN_GAIN = 1e-6
 
 
 def _index_neighbourhood(p, k, individual):
@@ -10,45 +20,242 @@ def _urand_neighbourhood(p, k, individual):
     return [i for i in np.random.choice(range(1, len(individual)), k, replace=False) if i != p]
 
 
+def _write_back(individual, costs):
+    """
+    Writes the improved tour into the individual and assigns its length, which the costs keep up to date. The moves
+    which led to it are attached as moves, so the result can be sent as moves.
+    """
+    np.frombuffer(individual, dtype=np.int32)[:] = costs.tour()
+    if hasattr(individual, 'fitness'):
+        individual.fitness.values = costs.length(),
+        individual.moves = costs.applied_moves()
+
+
 class TwoOptMutate(object):
-    def __init__(self, dist, eval_tsp, eval_tsp_fragment):
-        self.dist = dist
-        self.eval_tsp = eval_tsp
-        self.eval_tsp_fragment = eval_tsp_fragment
-
-    def __euclid_dist_rand_neighbourhood(self, p, k, individual):
-        euclid_dists_to_p = np.array([self.dist(individual[p], individual[i]) for i in range(len(individual))])
-        p_dist = 1. / (euclid_dists_to_p + 1.)
-        p_dist[p] = 0.
-        p_dist = p_dist / p_dist.sum()
-        return np.random.choice(range(len(individual)), k, replace=False, p=p_dist)
+    def __init__(self, tsp_instance, neighbours):
+        """
+        :param tsp_instance: TSP instance
+        :param neighbours: Candidate lists of the nearest neighbours of every city, shape (num_cities, K). The
+                           nearest neighbourhood of a city consists of min(k, K) of its candidates, the index
+                           neighbourhood of k positions
+        """
+        self.tsp_instance = tsp_instance
+        self.neighbours = neighbours
+
+    def __nearest_neighbourhood(self, p, k, individual, positions):
+        candidates = positions[self.neighbours[individual[p]]]
+        candidates = candidates[candidates > -1]  # city 0 is not part of the individual
+        if len(candidates) <= k:
+            return candidates
+        return np.random.choice(candidates, k, replace=False)
 
     def __call__(self, individual, k, rmp=0.5):
+        costs = TourCosts(self.tsp_instance, individual)
         total_gain = 0.0
         p = np.random.randint(len(individual))
-        neighbourhood_func = self.__euclid_dist_rand_neighbourhood if np.random.rand() < rmp else _index_neighbourhood
-        for n in neighbourhood_func(p, k, individual):
+        if np.random.rand() < rmp:
+            neighbourhood = self.__nearest_neighbourhood(p, k, individual, costs.position)
+        else:
+            neighbourhood = _index_neighbourhood(p, k, individual)
+        for n in neighbourhood:
             p1, p2 = min(p, n), max(p, n)
-            fragment = list(individual[p1:p2+1])
-            frag_len = self.eval_tsp_fragment(individual, fragment, p1)
-            min_len, min_frag = frag_len, None
-            nfragment = [individual[p2]] + list(individual[p1 + 1: p2]) + [individual[p1]]
-            nfrag_len = self.eval_tsp_fragment(individual, nfragment, p1)
-            if nfrag_len < min_len:
-                min_len = nfrag_len
-                min_frag = nfragment
-            nfragment = [individual[p2]] + list(individual[p2-1: p1:-1]) + [individual[p1]]
-            nfrag_len = self.eval_tsp_fragment(individual, nfragment, p1)
-            if nfrag_len < min_len:
-                min_frag = nfragment
-            if min_frag:
-                start_ind_len, = self.eval_tsp(individual)
-                for j in range(len(min_frag)):
-                    individual[p1 + j] = min_frag[j]
-                assert len(individual) == len(set(individual))
-                end_ind_len, = self.eval_tsp(individual)
-                gain = start_ind_len - end_ind_len
+            # the fragment p1..p2 is either kept, has its end points swapped or is reversed
+            swap_delta = costs.swap_delta(p1, p2)
+            reversal_delta = costs.reversal_delta(p1, p2)
+            if swap_delta < -_MIN_GAIN and swap_delta <= reversal_delta:
+                costs.swap(p1, p2)
+                total_gain -= swap_delta
+            elif reversal_delta < -_MIN_GAIN:
+                costs.reverse(p1, p2)
+                total_gain -= reversal_delta
+        _write_back(individual, costs)
+        Log.info(' [...] Achieved gain: %f' % total_gain)
+        return individual,
+
+
+class LocalSearchMutate(object):
+    """
+    Local search combining 2-opt and Or-opt (moving segments of 1 to 3 cities, optionally reversed) over the candidate
+    lists of the nearest neighbours. Cities whose neighbourhood did not yield an improvement are not looked at again
+    (don't-look bits) until a move changes one of their edges, which puts them back into the queue of dirty cities.
+    Runs until the queue is empty, i.e. a local optimum is reached, or the move or time budget is exhausted. Moves are
+    scored by TourCosts, so the prime penalty is exact.
+    """
+    def __init__(self, tsp_instance, neighbours, max_segment=3):
+        """
+        :param tsp_instance: TSP instance
+        :param neighbours: Candidate lists of the nearest neighbours of every city, shape (num_cities, K)
+        :param max_segment: Maximal number of cities moved by an Or-opt move
+        """
+        self.tsp_instance = tsp_instance
+        self.neighbours = neighbours
+        self.max_segment = max_segment
+
+    @staticmethod
+    def __two_opt_moves(i, j):
+        """The reversals (p1, p2) which make the cities at positions i and j adjacent."""
+        if i > j:
+            i, j = j, i
+        return (i + 1, j), (i, j - 1)
+
+    def __or_opt_moves(self, i, j, m):
+        """The segment moves (s, e, q, reverse) which put a segment starting or ending at i right next to j."""
+        for size in range(1, self.max_segment + 1):
+            for s, e, first in ((i, i + size - 1, True), (i - size + 1, i, False)):
+                if s < 0 or e >= m or s <= j <= e:
+                    continue
+                # after j the city at i must come first, before j it must come last
+                yield s, e, j, not first
+                yield s, e, j - 1, first
+
+    def __improve(self, costs, city, m):
+        """Applies the first improving move which adds an edge between city and one of its neighbours."""
+        position, dist, path = costs.position, costs.dist, costs.path
+        i = position[city]
+        # heuristic cut: neighbours whose new edge is longer than both edges it could replace are not tried. Moves
+        # change the steps, and with them the penalties, of whole segments, so it can miss improving moves
+        bound = 1.1 * max(dist[i + 1], dist[i + 2])
+        for other in self.neighbours[city]:
+            j = position[other]
+            if j < 0:
+                continue
+            if costs.distance(city, other) >= bound:
+                break
+            for p1, p2 in self.__two_opt_moves(i, j):
+                delta = costs.reversal_delta(p1, p2) if 0 <= p1 < p2 < m else 0.
+                if delta < -_MIN_GAIN:
+                    touched = path[[p1, p1 + 1, p2 + 1, p2 + 2]]
+                    costs.reverse(p1, p2)
+                    return -delta, touched
+            for s, e, q, reverse in self.__or_opt_moves(i, j, m):
+                delta = costs.segment_move_delta(s, e, q, reverse)
+                if delta < -_MIN_GAIN:
+                    touched = path[[s, s + 1, e + 1, e + 2, q + 1, q + 2]]
+                    costs.move_segment(s, e, q, reverse)
+                    return -delta, touched
+        return 0., ()
+
+    def __call__(self, individual, max_moves=1000, time_limit=5., start=0, end=0, offset=0):
+        """
+        Improves the individual, or a window of a tour between the cities start and end, the first edge of the window
+        being step offset + 1 (see TourCosts).
+        """
+        deadline = time.time() + time_limit
+        costs = TourCosts(self.tsp_instance, individual, start, end, offset)
+        m = len(individual)
+        dirty = collections.deque(np.random.permutation(np.asarray(individual)).tolist())
+        queued = np.zeros(len(self.neighbours), dtype=bool)
+        queued[dirty] = True
+        total_gain, moves = 0.0, 0
+        while dirty and moves < max_moves and time.time() < deadline:
+            city = dirty.popleft()
+            queued[city] = False
+            gain, touched = self.__improve(costs, city, m)
+            if gain > 0:
                 total_gain += gain
-        print(' [...] Achieved gain :%f' % total_gain)
+                moves += 1
+                for c in touched:
+                    # city 0 and the ends of a window are not part of the individual
+                    if costs.position[c] >= 0 and not queued[c]:
+                        queued[c] = True
+                        dirty.append(c)
+        _write_back(individual, costs)
+        Log.info(' [...] Achieved gain: %f in %d moves%s' % (total_gain, moves, '' if dirty else ', local optimum'))
+        return individual,
+
+
+class PrimePenaltyOptimizer(object):
+    """
+    Post-optimization of the prime penalty. Tries the reversal of the whole tour, then for every 10th step which
+    leaves a non-prime city the moves which put a prime city in its place: swaps with the cities of a window around
+    it and with the prime cities among its nearest neighbours, Or-moves of those prime cities into its position and
+    Or-moves of the non-prime city next to one of its neighbours. The moves are scored in O(1) by TourCosts and the
+    best improving one is applied. Passes over the tour are repeated until one yields no gain or time is up.
+    """
+    def __init__(self, tsp_instance, neighbours, window=3):
+        """
+        :param tsp_instance: TSP instance
+        :param neighbours: Candidate lists of the nearest neighbours of every city, shape (num_cities, K)
+        :param window: Distance in positions up to which the cities around a penalized step are tried
+        """
+        self.tsp_instance = tsp_instance
+        self.neighbours = neighbours
+        self.window = window
+
+    def __moves(self, costs, p, m):
+        """The candidate moves (op, a, b, c) for the city at the penalized position p of the individual."""
+        path, position, is_prime = costs.path, costs.position, self.tsp_instance.is_prime
+        for q in range(max(0, p - self.window), min(m, p + self.window + 1)):
+            if q != p:
+                yield SWAP, p, q, 0
+                if is_prime[path[q + 1]]:
+                    yield MOVE_SEGMENT, q, q, p - 1 if q > p else p
+        for other in self.neighbours[path[p + 1]]:
+            j = position[other]
+            if j < 0:
+                continue
+            if is_prime[other] and abs(j - p) > self.window:
+                yield SWAP, p, j, 0
+                yield MOVE_SEGMENT, j, j, p - 1 if j > p else p
+            yield MOVE_SEGMENT, p, p, j
+            yield MOVE_SEGMENT, p, p, j - 1
+
+    @staticmethod
+    def __delta(costs, op, a, b, c):
+        return costs.swap_delta(a, b) if op == SWAP else costs.segment_move_delta(a, b, c)
+
+    def __call__(self, individual, max_passes=10, time_limit=60.):
+        deadline = time.time() + time_limit
+        costs = TourCosts(self.tsp_instance, individual)
+        m = len(individual)
+        total_gain, moves = 0.0, 0
+        delta = costs.reversal_delta(0, m - 1)
+        if delta < -_MIN_GAIN:
+            costs.reverse(0, m - 1)
+            total_gain, moves = -delta, 1
+        for _ in range(max_passes):
+            pass_gain = 0.0
+            # step p + 2 leaves the city at position p of the individual
+            for p in range(8, m, 10):
+                if time.time() >= deadline:
+                    break
+                if not costs.non_prime[costs.path[p + 1]]:
+                    continue
+                best, best_delta = None, -_MIN_GAIN
+                for move in self.__moves(costs, p, m):
+                    delta = self.__delta(costs, *move)
+                    if delta < best_delta:
+                        best, best_delta = move, delta
+                if best is None:
+                    continue
+                op, a, b, c = best
+                if op == SWAP:
+                    costs.swap(a, b)
+                else:
+                    costs.move_segment(a, b, c)
+                pass_gain -= best_delta
+                moves += 1
+            total_gain += pass_gain
+            if pass_gain <= 0 or time.time() >= deadline:
+                break
+        _write_back(individual, costs)
+        Log.info(' [...] Recovered penalty: %f in %d moves' % (total_gain, moves))
         return individual,
 
+
+class WindowOptimizer(object):
+    """
+    Local search on a window of a tour: the cities between the fixed cities start and end, the first edge of the
+    window being step offset + 1 of the tour. Disjoint windows of a tour can be optimized independently.
+    """
+    def __init__(self, tsp_instance, neighbours):
+        self.tsp_instance = tsp_instance
+        self.local_search = LocalSearchMutate(tsp_instance, neighbours)
+
+    def __call__(self, window, start, end, offset, max_moves=100000, time_limit=30.):
+        """
+        :return: Tuple (window, decrease of the tour length)
+        """
+        before = TourCosts(self.tsp_instance, window, start, end, offset).length()
+        window, = self.local_search(window, max_moves, time_limit, start=start, end=end, offset=offset)
+        return window, before - window.fitness.values[0]
@@ -1,10 +1,13 @@
 import array
 import numpy as np
 import os
+import json
+import struct
 import shutil
 import logging
+import threading
 from deap import base, creator
-from collections import Iterable
+from collections.abc import Iterable
 
 
 Log = logging.getLogger(__name__)
@@ -12,6 +15,12 @@ Log = logging.getLogger(__name__)
 POP_DIR_NAME = 'population'
 NEW_POP_DIR_NAME = 'new_population'
 BEST_INDIVIDUAL_FNAME = 'best_individual.csv'
+CHECKPOINT_FNAME = 'population.bin'
+
+_CHECKPOINT_MAGIC = b'TSPPOP01'
+# magic, header length
+_CHECKPOINT_PREAMBLE = struct.Struct('<8sI')
+_CHECKPOINT_ALIGNMENT = 64
 
 
 creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
@@ -29,26 +38,88 @@ def individual_from(source):
             ls = [l.strip() for l in f.readlines()]
             indexes = [int(l) for l in ls if l]
             return creator.Individual(indexes)
+    elif isinstance(source, np.ndarray):
+        ind = creator.Individual()
+        ind.frombytes(memoryview(np.ascontiguousarray(source, dtype=np.int32)).cast('B'))
+        return ind
     elif isinstance(source, Iterable):
         return creator.Individual(source)
     else:
         raise Exception('Invalid individual creation method!')
 
 
-def init_population(num_cities, in_dir, pop_size=None):
+def write_checkpoint(tours, fitnesses, generation, out):
+    """
+    Writes the population as a single file: preamble, JSON header with the generation and the fitness values,
+    and the tours as one contiguous int32 matrix aligned for memory mapping. The file is written next to its
+    destination and renamed over it, so readers never see a partial checkpoint.
+    :param tours: Array of shape (pop_size, num_cities - 1)
+    :param fitnesses: Fitness value of every individual, None for invalid fitnesses
+    :param generation: Generation of the population
+    :param out: Checkpoint file
+    """
+    tours = np.ascontiguousarray(tours, dtype=np.int32)
+    header = {'generation': generation, 'shape': list(tours.shape), 'dtype': tours.dtype.str, 'fitness': fitnesses}
+    header = json.dumps(header).encode('utf-8')
+    offset = _CHECKPOINT_PREAMBLE.size + len(header)
+    padding = -offset % _CHECKPOINT_ALIGNMENT
+    tmp_out = out + '.tmp'
+    with open(tmp_out, 'wb') as f:
+        f.write(_CHECKPOINT_PREAMBLE.pack(_CHECKPOINT_MAGIC, len(header) + padding))
+        f.write(header + b' ' * padding)
+        f.write(memoryview(tours).cast('B'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_out, out)
+
+
+def read_checkpoint(source):
+    """
+    Reads a checkpoint written by write_checkpoint.
+    :param source: Checkpoint file
+    :return: Tuple (tours, fitnesses, generation), tours being a read-only memory map of the tours matrix
+    """
+    with open(source, 'rb') as f:
+        magic, header_len = _CHECKPOINT_PREAMBLE.unpack(f.read(_CHECKPOINT_PREAMBLE.size))
+        if magic != _CHECKPOINT_MAGIC:
+            raise Exception('Invalid checkpoint file %s' % source)
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    tours = np.memmap(source, dtype=np.dtype(header['dtype']), mode='r',
+                      offset=_CHECKPOINT_PREAMBLE.size + header_len, shape=tuple(header['shape']))
+    return tours, header['fitness'], header['generation']
+
+
+def checkpoint_generation(in_dir):
+    """Generation of the population checkpointed in in_dir, None if there is no checkpoint."""
+    checkpoint = os.path.join(in_dir, CHECKPOINT_FNAME)
+    if not os.path.exists(checkpoint):
+        return None
+    return read_checkpoint(checkpoint)[2]
+
+
+def init_population(num_cities, in_dir, pop_size=None, generate=generate_population):
     assert in_dir is not None
     Log.info('Initializing population...')
+    checkpoint = os.path.join(in_dir, CHECKPOINT_FNAME)
+    if os.path.exists(checkpoint):
+        Log.info('Loading population checkpoint...')
+        tours, fitnesses, _ = read_checkpoint(checkpoint)
+        population = [individual_from(tour) for tour in tours]
+        for ind, fit in zip(population, fitnesses):
+            if fit is not None:
+                ind.fitness.values = fit,
+        return population
     pop_dir = os.path.join(in_dir, POP_DIR_NAME)
     if not os.path.exists(in_dir) or not os.path.exists(pop_dir):
-        Log.info('Generating individuals randomly...')
-        return generate_population(num_cities, pop_size)
+        Log.info('Generating individuals...')
+        return generate(num_cities, pop_size)
     inds_fnames = os.listdir(pop_dir)
     if len(inds_fnames):
         Log.info('Loading population from disk...')
         return [individual_from(os.path.join(pop_dir, fname)) for fname in inds_fnames]
     else:
-        Log.info('Generating individuals randomly...')
-        return generate_population(num_cities, pop_size)
+        Log.info('Generating individuals...')
+        return generate(num_cities, pop_size)
 
 
 def _create_dirs(out_dir):
@@ -93,5 +164,63 @@ def save_population(population, out_dir):
     shutil.move(new_pop_dir, os.path.join(out_dir, POP_DIR_NAME))
 
 
-
-
+class CheckpointWriter(object):
+    """
+    Writes population checkpoints from a background thread, every `every` calls. The population is copied into
+    a matrix by the caller, so the generation loop only pays for that copy. If the writer falls behind, only the
+    most recent pending snapshot is written.
+    """
+
+    def __init__(self, out_dir, every=1):
+        assert out_dir is not None
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.out = os.path.join(out_dir, CHECKPOINT_FNAME)
+        self.every = max(1, every)
+        self.num_calls = 0
+        self.last = None  # last population handed in, written on close if it was skipped
+        self.snapshot = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.thread.start()
+
+    def __write_loop(self):
+        while True:
+            with self.condition:
+                while self.snapshot is None and not self.closed:
+                    self.condition.wait()
+                if self.snapshot is None:
+                    return
+                snapshot, self.snapshot = self.snapshot, None
+            try:
+                write_checkpoint(*snapshot, out=self.out)
+                Log.info('Saved population checkpoint of generation %s' % snapshot[2])
+            except Exception as e:
+                Log.error('Failed to save population checkpoint: %s' % e)
+
+    def __submit(self, population, gen):
+        tours = np.stack([np.asarray(ind) for ind in population])
+        fitnesses = [ind.fitness.values[0] if ind.fitness.valid else None for ind in population]
+        with self.condition:
+            self.snapshot = (tours, fitnesses, gen)
+            self.condition.notify()
+
+    def __call__(self, population, gen=None):
+        self.num_calls += 1
+        if self.num_calls % self.every == 0:
+            self.__submit(population, gen)
+            self.last = None
+        else:
+            # the individuals are replaced, not changed in place, so a copy of the list keeps this generation
+            self.last = (list(population), gen)
+
+    def close(self):
+        """Writes the pending snapshots and stops the writer thread."""
+        if self.last is not None:
+            self.__submit(*self.last)
+            self.last = None
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,104 @@
+import json
+import zlib
+import array
+import struct
+import numpy as np
+
+MAGIC = b'TSPB'
+VERSION = 1
+FLAG_ZLIB = 0x1
+# magic, version, flags, header length
+_PREAMBLE = struct.Struct('<4sBBI')
+_ALIGNMENT = 8
+# level used for the replies to compressed requests
+_REPLY_COMPRESS_LEVEL = 1
+
+
+def _is_array(value):
+    return isinstance(value, (array.array, np.ndarray))
+
+
+def _as_numpy(value):
+    if isinstance(value, array.array):
+        return np.frombuffer(value, dtype=np.dtype(value.typecode)) if len(value) else np.empty(0, np.int32)
+    return np.ascontiguousarray(value)
+
+
+def _encode_binary(messages, compress_level):
+    """
+    Frames the messages as: preamble, JSON header and the raw buffers of the arrays. Scalar values of the messages
+    are stored in the header, arrays (tours) are appended to the payload and referenced by offset and length.
+    """
+    header, buffers, offset = {'messages': [], 'arrays': []}, [], 0
+    for i, message in enumerate(messages):
+        scalars = {}
+        for key, value in message.items():
+            if _is_array(value):
+                arr = _as_numpy(value)
+                header['arrays'].append([i, key, arr.dtype.str, offset, len(arr)])
+                padding = -arr.nbytes % _ALIGNMENT
+                buffers.append(memoryview(arr).cast('B'))
+                buffers.append(b'\0' * padding)
+                offset += arr.nbytes + padding
+            else:
+                scalars[key] = value
+        header['messages'].append(scalars)
+    header = json.dumps(header).encode('utf-8')
+    # padded with whitespace, so that the buffers are aligned in the message, or in the decompressed payload
+    lead = 0 if compress_level > 0 else _PREAMBLE.size
+    header += b' ' * (-(lead + len(header)) % _ALIGNMENT)
+    body = b''.join([header] + buffers)
+    flags = 0
+    if compress_level > 0:
+        body = zlib.compress(body, compress_level)
+        flags |= FLAG_ZLIB
+    return _PREAMBLE.pack(MAGIC, VERSION, flags, len(header)) + body
+
+
+def _decode_binary(body):
+    magic, version, flags, header_len = _PREAMBLE.unpack_from(body)
+    if version != VERSION:
+        raise Exception('Unsupported message version %d' % version)
+    data = memoryview(body)[_PREAMBLE.size:]
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    header = json.loads(bytes(data[:header_len]).decode('utf-8'))
+    messages = header['messages']
+    for i, key, dtype, offset, count in header['arrays']:
+        messages[i][key] = np.frombuffer(data, dtype=np.dtype(dtype), count=count, offset=header_len + offset)
+    return messages, flags
+
+
+def _to_json_value(value):
+    return _as_numpy(value).tolist() if _is_array(value) else value
+
+
+class Codec(object):
+    """
+    Encodes lists of task or result messages. Messages are dicts of scalars and int32 arrays.
+    The binary format keeps arrays as raw buffers, optionally zlib compressed, and decodes them into numpy arrays
+    without intermediate lists. The JSON format encodes a single message as an object (the original task format)
+    and several messages as a list.
+    """
+    def __init__(self, binary=True, compress_level=0):
+        self.binary = binary
+        self.compress_level = compress_level
+
+    def encode(self, messages):
+        if self.binary:
+            return _encode_binary(messages, self.compress_level)
+        messages = [{k: _to_json_value(v) for k, v in m.items()} for m in messages]
+        return json.dumps(messages[0] if len(messages) == 1 else messages).encode('utf-8')
+
+    @staticmethod
+    def decode(body):
+        """
+        Decodes a message body in any of the supported formats.
+        :param body: Message body
+        :return: Tuple (messages, codec), the codec encodes the replies in the format of the body
+        """
+        if body[:len(MAGIC)] == MAGIC:
+            messages, flags = _decode_binary(body)
+            return messages, Codec(binary=True, compress_level=_REPLY_COMPRESS_LEVEL if flags & FLAG_ZLIB else 0)
+        messages = json.loads(body.decode('utf-8'))
+        return messages if isinstance(messages, list) else [messages], Codec(binary=False)
@@ -0,0 +1,76 @@
+import numpy as np
+
+# number of query points whose distances are computed at once
+_QUERY_BLOCK_SIZE = 256
+
+
+class GridIndex(object):
+    """
+    Uniform grid over the cities, with cells holding on average `density` cities. The cities are sorted by cell,
+    cells of the same grid column being consecutive, so the cities of a column range of cells are a contiguous slice.
+    """
+    def __init__(self, points, density=8):
+        self.points = np.asarray(points, dtype=np.float64)
+        n = len(self.points)
+        self.origin = self.points.min(axis=0)
+        span = np.maximum(self.points.max(axis=0) - self.origin, 1e-9)
+        self.cell_size = max(np.sqrt(span[0] * span[1] * density / max(n, 1)), 1e-9)
+        self.shape = (np.floor(span / self.cell_size).astype(np.int64) + 1)
+        self.cell_coords = np.floor((self.points - self.origin) / self.cell_size).astype(np.int64)
+        cell_ids = self.cell_coords[:, 0] * self.shape[1] + self.cell_coords[:, 1]
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.starts = np.searchsorted(cell_ids[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def cells(self):
+        """Yields the coordinates of the non empty cells and the indexes of their cities."""
+        nonempty = np.nonzero(self.starts[1:] > self.starts[:-1])[0]
+        for cell_id in nonempty:
+            cx, cy = divmod(int(cell_id), int(self.shape[1]))
+            yield (cx, cy), self.order[self.starts[cell_id]:self.starts[cell_id + 1]]
+
+    def block(self, cx, cy, r):
+        """Indexes of the cities in the square block of cells at Chebyshev distance up to r from cell (cx, cy)."""
+        gx, gy = self.shape
+        lo_y, hi_y = max(cy - r, 0), min(cy + r, gy - 1)
+        slices = [self.order[self.starts[x * gy + lo_y]:self.starts[x * gy + hi_y + 1]]
+                  for x in range(max(cx - r, 0), min(cx + r, gx - 1) + 1)]
+        return np.concatenate(slices)
+
+    def covers_all(self, cx, cy, r):
+        gx, gy = self.shape
+        return cx - r <= 0 and cy - r <= 0 and cx + r >= gx - 1 and cy + r >= gy - 1
+
+
+def nearest_neighbours(points, k):
+    """
+    Computes the k nearest neighbours of every point with a grid index. For the cities of a cell the search block
+    grows until it holds enough candidates and the k-th nearest candidate is closer than any city outside the block.
+    :param points: Array of shape (n, 2) with the coordinates
+    :param k: Number of neighbours
+    :return: Array of shape (n, k) of neighbour indexes sorted by increasing distance
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    k = min(k, n - 1)
+    neighbours = np.empty((n, k), dtype=np.int32)
+    if k <= 0:
+        return neighbours
+    grid = GridIndex(points)
+    for (cx, cy), members in grid.cells():
+        for i in range(0, len(members), _QUERY_BLOCK_SIZE):
+            queries = members[i:i + _QUERY_BLOCK_SIZE]
+            r = 1
+            while True:
+                candidates = grid.block(cx, cy, r)
+                if len(candidates) > k:
+                    diff = points[queries][:, None, :] - points[candidates][None, :, :]
+                    dists = np.sqrt(np.sum(np.square(diff), axis=-1))
+                    dists[queries[:, None] == candidates[None, :]] = np.inf
+                    nearest = np.argpartition(dists, k - 1, axis=1)[:, :k]
+                    nearest_dists = np.take_along_axis(dists, nearest, axis=1)
+                    if grid.covers_all(cx, cy, r) or nearest_dists.max() <= r * grid.cell_size:
+                        by_dist = np.argsort(nearest_dists, axis=1, kind='stable')
+                        neighbours[queries] = candidates[np.take_along_axis(nearest, by_dist, axis=1)]
+                        break
+                r += 1
+    return neighbours
@@ -0,0 +1,150 @@
+import csv
+import time
+import logging
+import threading
+import contextlib
+import collections
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+Log = logging.getLogger(__name__)
+
+TASKS_FNAME = 'tasks.csv'
+GENERATIONS_FNAME = 'generations.csv'
+
+# queue_wait and reply_latency compare clocks of master and worker, they are only as exact as the clock sync
+TASK_FIELDS = ['corr_id', 'worker', 'tasks', 'published', 'queue_wait', 'decode', 'operator', 'encode',
+               'reply_latency', 'reply_decode', 'total']
+# names of the AMQP headers with which workers report their timings
+RECEIVED_HEADER = 'tspea-received'
+REPLIED_HEADER = 'tspea-replied'
+WORKER_HEADER = 'tspea-worker'
+DECODE_HEADER = 'tspea-decode'
+OPERATOR_HEADER = 'tspea-operator'
+ENCODE_HEADER = 'tspea-encode'
+
+
+def to_header(seconds):
+    """AMQP tables have no floating point type, times travel as integer microseconds."""
+    return int(round(seconds * 1e6))
+
+
+def from_header(value):
+    return value / 1e6 if value is not None else None
+
+
+class Metrics(object):
+    """
+    Thread-safe count, sum and maximum of observed values, rendered in the Prometheus text format.
+    """
+    def __init__(self, prefix='tspea'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.summaries = collections.OrderedDict()  # (name, labels) -> [count, sum, max]
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.setdefault(key, [0, 0., float('-inf')])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, labels), (count, total, maximum) in self.summaries.items():
+                label_str = '{%s}' % ','.join('%s="%s"' % kv for kv in labels) if labels else ''
+                for suffix, value in (('count', count), ('sum', total), ('max', maximum)):
+                    lines.append('%s_%s_%s%s %r' % (self.prefix, name, suffix, label_str, value))
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, metrics):
+    """Serves the metrics on http://0.0.0.0:port/metrics from a daemon thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Log.info('Serving metrics on port %d' % port)
+    return server
+
+
+class Recorder(object):
+    """
+    Appends timing records to a CSV file and observes their numeric fields in the metrics. Thread-safe.
+    """
+    def __init__(self, out, fields, name, metrics=None):
+        self.fields = fields
+        self.name = name
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.file = open(out, 'a', newline='') if out is not None else None
+        self.writer = csv.DictWriter(self.file, fields, extrasaction='ignore') if self.file else None
+        if self.file is not None and self.file.tell() == 0:
+            self.writer.writeheader()
+
+    def record(self, **values):
+        if self.metrics is not None:
+            for field, value in values.items():
+                if isinstance(value, float) and field != 'published':
+                    self.metrics.observe('%s_%s_seconds' % (self.name, field), value)
+        if self.writer is not None:
+            with self.lock:
+                self.writer.writerow(values)
+                self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            with self.lock:
+                self.file.close()
+                self.file, self.writer = None, None
+
+
+class GenerationTimer(object):
+    """
+    Accumulates the wall time of the phases of a generation and records them when the generation is finished.
+    """
+    def __init__(self, phases, recorder=None):
+        self.phases = phases
+        self.recorder = recorder
+        self.elapsed = dict.fromkeys(phases, 0.)
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed[name] += time.perf_counter() - st
+
+    def finish(self, gen):
+        total = time.perf_counter() - self.started
+        if self.recorder is not None:
+            self.recorder.record(gen=gen, total=total, **self.elapsed)
+        Log.info('Generation %d took %f s: %s' % (gen, total, ', '.join('%s %f' % kv for kv in self.elapsed.items())))
+        self.elapsed = dict.fromkeys(self.phases, 0.)
+        self.started = time.perf_counter()
+
+
+class NullGenerationTimer(object):
+    """Generation timer which measures nothing, used when the toolbox has no timer registered."""
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def finish(self, gen):
+        pass
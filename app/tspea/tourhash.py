@@ -0,0 +1,108 @@
+import collections
+import threading
+import numpy as np
+
+# fixed, so that the hashes computed by the master and the workers agree
+_SEED = 0x5A17A
+_ORIENTATION_SALT = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(z):
+    """splitmix64 finalizer of an uint64 array."""
+    z = z ^ (z >> np.uint64(30))
+    z = z * np.uint64(0xBF58476D1CE4E5B9)
+    z = z ^ (z >> np.uint64(27))
+    z = z * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+class TourHash(object):
+    """
+    Zobrist-style 64 bit hash of a tour: the XOR of the keys of its undirected edges, the key of an edge being a
+    non-linear mix of the random keys of its cities. The first city of the individual is mixed in as well, because a
+    tour and its reverse have the same edges but not the same length. Hashing a tour takes O(n).
+    """
+    def __init__(self, num_cities, seed=_SEED):
+        self.keys = np.random.RandomState(seed).randint(0, np.iinfo(np.int64).max, size=num_cities, dtype=np.int64) \
+            .astype(np.uint64)
+
+    def edge_keys(self, a, b):
+        return _mix(self.keys[np.asarray(a)] + self.keys[np.asarray(b)])
+
+    def __orientation(self, first):
+        return int(_mix(self.keys[[first]] ^ _ORIENTATION_SALT)[0])
+
+    def __edges(self, a, b):
+        return int(np.bitwise_xor.reduce(self.edge_keys(a, b)))
+
+    def __call__(self, individual):
+        path = np.concatenate(([0], np.asarray(individual, dtype=np.int64), [0]))
+        return self.__edges(path[:-1], path[1:]) ^ self.__orientation(path[1])
+
+
+class FitnessCache(object):
+    """
+    Bounded LRU map of tour hashes to fitness values.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tour_hash):
+        fitness = self.entries.get(tour_hash)
+        if fitness is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(tour_hash)
+        return fitness
+
+    def put(self, tour_hash, fitness):
+        self.entries[tour_hash] = fitness
+        self.entries.move_to_end(tour_hash)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TourCache(object):
+    """
+    LRU map of tour hashes to tours, bounded by the total size of the cached tours. It is thread-safe, the threads of
+    a worker share it.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, tour_hash):
+        with self.lock:
+            tour = self.entries.get(tour_hash)
+            if tour is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(tour_hash)
+            return tour
+
+    def put(self, tour_hash, tour):
+        tour = np.array(tour, dtype=np.int32)
+        with self.lock:
+            if tour_hash in self.entries:
+                self.entries.move_to_end(tour_hash)
+                return
+            self.entries[tour_hash] = tour
+            self.num_bytes += tour.nbytes
+            while self.num_bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,17 +1,28 @@
 import pika
-import json
 import time
 import functools
 import os
+import socket
+import random
 import logging
+import multiprocessing
+import numpy as np
 from deap import base
 from .fitness import TSPInstance, EvalTSPSolution, EvalTSPSolutionFragment
-from .mutation import TwoOptMutate
-from .crossover import edge_recombination
-from .messaging import declare_topology, ack_message, TASK_QUEUE, MATE, MUTATE, FIRST, SECOND, TYPE, GEN, \
-    TERM_SIG_EXCHANGE
+from .mutation import TwoOptMutate, LocalSearchMutate, PrimePenaltyOptimizer, WindowOptimizer
+from .crossover import edge_recombination, PartitionCrossover
+from .construction import TourConstructor
+from .messaging import declare_topology, ack_message, TASK_QUEUE, MATE, MUTATE, MATE_MUTATE, EVALUATE, CONSTRUCT, \
+    OPTIMIZE, WINDOW, START, END, OFFSET, GAIN, METHOD, SEED, FIRST, \
+    SECOND, MUTATE_FIRST, MUTATE_SECOND, FITNESS_FIRST, FITNESS_SECOND, REPLY_MOVES, MOVES, FIRST_REF, SECOND_REF, \
+    TOUR_MISS, ERROR, TYPE, GEN, TERM_SIG_EXCHANGE
 from .population import individual_from
+from .serialization import Codec
+from .moves import apply_moves
+from .tourhash import TourHash, TourCache
 from .utils import async_func
+from .telemetry import Metrics, serve_metrics, RECEIVED_HEADER, REPLIED_HEADER, WORKER_HEADER, DECODE_HEADER, \
+    OPERATOR_HEADER, ENCODE_HEADER, to_header
 
 Log = logging.getLogger(__name__)
 
@@ -25,44 +36,194 @@ def _connect(broker_url):
     return connection, channel, term_sig_queue.method.queue
 
 
+def _offspring_result(toolbox, *offspring):
+    """
+    Result of a task with the offspring and their fitness values. Mutation operators which track the tour length
+    have already assigned it, the other offspring are evaluated.
+    """
+    result = {}
+    for off, key, fitness_key in zip(offspring, (FIRST, SECOND), (FITNESS_FIRST, FITNESS_SECOND)):
+        result[key] = off
+        result[fitness_key] = off.fitness.values[0] if off.fitness.valid else toolbox.evaluate(off)[0]
+    return result
+
+
+def _improved_result(task, toolbox, off):
+    """
+    Result of a task which improves the tour of the task, with the moves instead of the offspring if the task asks
+    for them and they are shorter.
+    """
+    result = _offspring_result(toolbox, off)
+    moves = getattr(off, 'moves', None)
+    if task.get(REPLY_MOVES) and moves is not None and len(moves) < len(off):
+        del result[FIRST]
+        result[MOVES] = moves
+    return result
+
+
 def _process_task(task, toolbox):
     if task[TYPE] == MATE:
         ind1, ind2 = task[FIRST], task[SECOND]
         off1, off2 = toolbox.mate(individual_from(ind1), individual_from(ind2))
-        return {FIRST: list(off1), SECOND: list(off2)}
+        return _offspring_result(toolbox, off1, off2)
     elif task[TYPE] == MUTATE:
-        ind = task[FIRST]
-        off, = toolbox.mutate(individual_from(ind))
-        return {FIRST: list(off)}
+        off, = toolbox.mutate(individual_from(task[FIRST]))
+        return _improved_result(task, toolbox, off)
+    elif task[TYPE] == OPTIMIZE:
+        off, = toolbox.optimize(individual_from(task[FIRST]))
+        return _improved_result(task, toolbox, off)
+    elif task[TYPE] == WINDOW:
+        window, gain = toolbox.optimize_window(individual_from(task[FIRST]), task[START], task[END], task[OFFSET])
+        return {FIRST: window, GAIN: gain}
+    elif task[TYPE] == MATE_MUTATE:
+        ind1, ind2 = task[FIRST], task[SECOND]
+        off1, off2 = toolbox.mate(individual_from(ind1), individual_from(ind2))
+        if task[MUTATE_FIRST]:
+            off1, = toolbox.mutate(off1)
+        if task[MUTATE_SECOND]:
+            off2, = toolbox.mutate(off2)
+        return _offspring_result(toolbox, off1, off2)
+    elif task[TYPE] == EVALUATE:
+        return {FITNESS_FIRST: toolbox.evaluate(individual_from(task[FIRST]))[0]}
+    elif task[TYPE] == CONSTRUCT:
+        return _offspring_result(toolbox, individual_from(toolbox.construct(task[METHOD], task[SEED])))
     else:
         Log.error('Invalid task type ' + task[TYPE])
         raise Exception('Invalid task type')
 
 
-def _on_request_func(connection, toolbox):
+def _resolve_tours(tasks):
+    """
+    Caches the tours which come with their hash and puts the cached tours in place of the references.
+    :return: False if a referenced tour is not cached
+    """
+    for task in tasks:
+        for key, ref in ((FIRST, FIRST_REF), (SECOND, SECOND_REF)):
+            if key in task and ref in task:
+                _tour_cache.put(task[ref], task[key])
+    resolved = True
+    for task in tasks:
+        for key, ref in ((FIRST, FIRST_REF), (SECOND, SECOND_REF)):
+            if key not in task and ref in task:
+                task[key] = _tour_cache.get(task[ref])
+                resolved = resolved and task[key] is not None
+    return resolved
 
-    @async_func
-    def on_request(ch, method, props, body):
-        task = json.loads(body.decode('utf-8'))
 
-        st = time.time()
+def _cache_offspring(task, result, toolbox):
+    """
+    Caches the offspring of a task whose tours came with their hash, the hashes travel back with the result so that
+    the master knows this worker holds them.
+    """
+    for key, ref in ((FIRST, FIRST_REF), (SECOND, SECOND_REF)):
+        tour = result.get(key)
+        if tour is None and key == FIRST and MOVES in result:
+            tour = apply_moves(np.array(task[FIRST], dtype=np.int32), result[MOVES])
+        if tour is not None:
+            result[ref] = toolbox.tour_hash(tour)
+            _tour_cache.put(result[ref], tour)
+
+
+def _process_timed_message(body, toolbox=None):
+    """
+    Processes the tasks of a message. Without an explicit toolbox the one of the worker is used, which the processes
+    of the pool inherit.
+    :return: Tuple (encoded response, timings, worker name), timings being the seconds spent decoding the message,
+             in the operators and encoding the response
+    """
+    toolbox = toolbox if toolbox is not None else _toolbox
+    st = time.perf_counter()
+    tasks, codec = Codec.decode(body)
+    timings = {DECODE_HEADER: time.perf_counter() - st, OPERATOR_HEADER: 0.}
+
+    if not _resolve_tours(tasks):
+        Log.info(" [.] Referenced tour not cached, asking for the tours")
+        return codec.encode([{TOUR_MISS: True} for _ in tasks]), timings, _WORKER_NAME
+    response = []
+    for task in tasks:
+        st = time.perf_counter()
         Log.info(" [.] Received '%s' task, generation: %d. Processing..." % (task[TYPE], task[GEN]))
-        response = _process_task(task, toolbox)
-        et = time.time()
-        Log.info(" [...] Finished processing, elapsed time: %f. Publishing response" % (et - st))
+        result = _process_task(task, toolbox)
+        if task[TYPE] != WINDOW and FIRST_REF in task:
+            _cache_offspring(task, result, toolbox)
+        response.append(result)
+        elapsed = time.perf_counter() - st
+        timings[OPERATOR_HEADER] += elapsed
+        Log.info(" [...] Finished processing, elapsed time: %f." % elapsed)
+    st = time.perf_counter()
+    response_body = codec.encode(response)
+    timings[ENCODE_HEADER] = time.perf_counter() - st
+    return response_body, timings, _WORKER_NAME
+
+
+def _process_message(body, toolbox=None):
+    """
+    Processes the tasks of a message and returns the encoded response.
+    """
+    return _process_timed_message(body, toolbox)[0]
+
+
+def _reply_func(connection, ch, method, props, received=None):
+
+    def reply(result):
+        response_body, timings, worker_name = result
+        Log.info(" [...] Publishing response")
+        for header, value in timings.items():
+            _metrics.observe(header.replace('tspea-', 'task_') + '_seconds', value)
+        headers = {header: to_header(value) for header, value in timings.items()}
+        headers[WORKER_HEADER] = worker_name
+        headers[RECEIVED_HEADER] = to_header(received if received is not None else time.time())
+        headers[REPLIED_HEADER] = to_header(time.time())
         # publish the response
         publish_callback = functools.partial(ch.basic_publish,
                                              exchange='',
                                              routing_key=props.reply_to,
                                              properties=pika.BasicProperties(correlation_id=props.correlation_id,
-                                                                             delivery_mode=1),
-                                             body=json.dumps(response))
+                                                                             delivery_mode=1,
+                                                                             headers=headers),
+                                             body=response_body)
         if ch.is_open:
             connection.add_callback_threadsafe(publish_callback)
         # acknowledge original message
         ack_callback = functools.partial(ack_message, ch, method.delivery_tag)
         connection.add_callback_threadsafe(ack_callback)
 
+    return reply
+
+
+def _error_result(e):
+    """Reply to a message which failed, the master raises the error."""
+    Log.error('Failed to process task: %s' % e)
+    return Codec().encode([{ERROR: repr(e)}]), {}, _WORKER_NAME
+
+
+def _on_request_func(connection, toolbox):
+
+    @async_func
+    def on_request(ch, method, props, body):
+        reply = _reply_func(connection, ch, method, props, time.time())
+        try:
+            result = _process_timed_message(body, toolbox)
+        except Exception as e:
+            # the master is told, the message is acknowledged with the reply
+            result = _error_result(e)
+        reply(result)
+
+    return on_request
+
+
+def _on_pool_request_func(connection, pool):
+
+    def on_request(ch, method, props, body):
+        # the reply callbacks run in the result handler thread of the pool, the connection thread publishes the reply
+        reply = _reply_func(connection, ch, method, props, time.time())
+
+        def on_error(e):
+            # the master is told, the message is acknowledged with the reply
+            reply(_error_result(e))
+
+        pool.apply_async(_process_timed_message, (body,), callback=reply, error_callback=on_error)
+
     return on_request
 
 
@@ -75,30 +236,101 @@ def _on_term_signal_receive_func(connection):
     return on_term_signal_receive
 
 
-def _consume(broker_url, toolbox):
+def _consume(broker_url, toolbox, pool=None, prefetch_count=1):
     Log.info(" [x] Connecting to RabbitMQ...")
     connection, channel, term_sig_queue = _connect(broker_url)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(_on_request_func(connection, toolbox), queue=TASK_QUEUE)
+    channel.basic_qos(prefetch_count=prefetch_count)
+    if pool is not None:
+        channel.basic_consume(_on_pool_request_func(connection, pool), queue=TASK_QUEUE)
+    else:
+        channel.basic_consume(_on_request_func(connection, toolbox), queue=TASK_QUEUE)
     channel.basic_consume(_on_term_signal_receive_func(connection), queue=term_sig_queue, no_ack=True)
     Log.info(" [x] Awaiting requests")
     channel.start_consuming()
 
 
+def _init_process():
+    global _WORKER_NAME, _tour_cache
+    # forked processes inherit the random state of the parent
+    random.seed()
+    np.random.seed()
+    # each process has its own tour cache and is a worker of its own for the master
+    _WORKER_NAME = _worker_name()
+    _tour_cache = TourCache(WORKER_TOUR_CACHE_MB * 2 ** 20)
+
+
 LSEARCH_NBOUR_SIZE = int(os.getenv('LSEARCH_NBOUR_SIZE', 100))
 RAND_SEARCH_PROB = float(os.getenv('RAND_SEARCH_PROB', 0.5))
+NEAREST_NBOURS_SIZE = int(os.getenv('NEAREST_NBOURS_SIZE', 16))
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', os.cpu_count() or 1))
+# a single process takes one message at a time
+WORKER_PREFETCH = int(os.getenv('WORKER_PREFETCH', 2 * WORKER_PROCESSES if WORKER_PROCESSES > 1 else 1))
+CROSSOVER_OPERATOR = os.getenv('CROSSOVER_OPERATOR', 'erx')
+METRICS_PORT = os.getenv('METRICS_PORT', None)
+MUTATION_OPERATOR = os.getenv('MUTATION_OPERATOR', '2opt')
+LSEARCH_MAX_MOVES = int(os.getenv('LSEARCH_MAX_MOVES', 1000))
+LSEARCH_TIME_LIMIT = float(os.getenv('LSEARCH_TIME_LIMIT', 5.))
+PENALTY_OPT_TIME_LIMIT = float(os.getenv('PENALTY_OPT_TIME_LIMIT', 60.))
+WINDOW_MAX_MOVES = int(os.getenv('WINDOW_MAX_MOVES', 100000))
+WINDOW_TIME_LIMIT = float(os.getenv('WINDOW_TIME_LIMIT', 30.))
+WORKER_TOUR_CACHE_MB = int(os.getenv('WORKER_TOUR_CACHE_MB', 128))
 
+_toolbox = None
+_metrics = Metrics()
+_tour_cache = TourCache(WORKER_TOUR_CACHE_MB * 2 ** 20)
 
-def run(cities_file, broker_url):
-    Log.info('Starting worker...')
+
+def _worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+_WORKER_NAME = _worker_name()
+
+
+def create_toolbox(tsp_instance):
     toolbox = base.Toolbox()
-    tsp_instance = TSPInstance(cities_file)
     toolbox.register('evaluate', EvalTSPSolution(tsp_instance))
+    toolbox.register('tour_hash', TourHash(tsp_instance.size()))
     toolbox.register('evaluate_fragment', EvalTSPSolutionFragment(tsp_instance))
-    toolbox.register('mate', edge_recombination)
-    toolbox.register('mutate', TwoOptMutate(tsp_instance.distance, toolbox.evaluate, toolbox.evaluate_fragment),
-                     k=LSEARCH_NBOUR_SIZE, rmp=RAND_SEARCH_PROB)
-    _consume(broker_url, toolbox)
-
+    if CROSSOVER_OPERATOR == 'gpx':
+        toolbox.register('mate', PartitionCrossover(tsp_instance))
+    elif CROSSOVER_OPERATOR == 'erx':
+        toolbox.register('mate', edge_recombination)
+    else:
+        raise ValueError('Unknown crossover operator: %s' % CROSSOVER_OPERATOR)
+    neighbours = tsp_instance.nearest_neighbours(NEAREST_NBOURS_SIZE)
+    if MUTATION_OPERATOR == 'lsearch':
+        toolbox.register('mutate', LocalSearchMutate(tsp_instance, neighbours),
+                         max_moves=LSEARCH_MAX_MOVES, time_limit=LSEARCH_TIME_LIMIT)
+    elif MUTATION_OPERATOR == '2opt':
+        if LSEARCH_NBOUR_SIZE > NEAREST_NBOURS_SIZE:
+            Log.warning('The nearest neighbourhoods of the 2-opt mutation are limited to the %d candidates of the '
+                        'cities' % NEAREST_NBOURS_SIZE)
+        toolbox.register('mutate', TwoOptMutate(tsp_instance, neighbours),
+                         k=LSEARCH_NBOUR_SIZE, rmp=RAND_SEARCH_PROB)
+    else:
+        raise ValueError('Unknown mutation operator: %s' % MUTATION_OPERATOR)
+    toolbox.register('construct', TourConstructor(tsp_instance, neighbours))
+    toolbox.register('optimize', PrimePenaltyOptimizer(tsp_instance, neighbours), time_limit=PENALTY_OPT_TIME_LIMIT)
+    toolbox.register('optimize_window', WindowOptimizer(tsp_instance, neighbours), max_moves=WINDOW_MAX_MOVES,
+                     time_limit=WINDOW_TIME_LIMIT)
+    return toolbox
 
 
+def run(cities_file, broker_url):
+    global _toolbox
+    Log.info('Starting worker...')
+    if METRICS_PORT is not None:
+        serve_metrics(int(METRICS_PORT), _metrics)
+    tsp_instance = TSPInstance(cities_file)
+    _toolbox = create_toolbox(tsp_instance)
+    if WORKER_PROCESSES > 1:
+        Log.info('Starting %d worker processes...' % WORKER_PROCESSES)
+        # forked processes share the read-only instance data of this process
+        pool = multiprocessing.get_context('fork').Pool(WORKER_PROCESSES, initializer=_init_process)
+        try:
+            _consume(broker_url, _toolbox, pool=pool, prefetch_count=WORKER_PREFETCH)
+        finally:
+            pool.terminate()
+    else:
+        _consume(broker_url, _toolbox, prefetch_count=WORKER_PREFETCH)
@@ -0,0 +1,39 @@
+"""
+Synthetic city files in the format of the Santa competition (CityId,X,Y). City ids are consecutive, so the prime
+penalty applies to the same share of the cities as in the original data.
+
+    python -m benchmarks.cities out.csv num_cities [uniform|clustered]
+"""
+import sys
+import numpy as np
+import pandas as pd
+
+WIDTH, HEIGHT = 5100., 3400.
+LAYOUTS = ('uniform', 'clustered')
+
+
+def generate_cities(num_cities, layout='uniform', seed=0):
+    """
+    :return: Array of shape (num_cities, 2) with the coordinates of the cities
+    """
+    rng = np.random.RandomState(seed)
+    if layout == 'uniform':
+        return rng.uniform((0., 0.), (WIDTH, HEIGHT), size=(num_cities, 2))
+    elif layout == 'clustered':
+        num_clusters = max(1, num_cities // 1000)
+        centers = rng.uniform((0., 0.), (WIDTH, HEIGHT), size=(num_clusters, 2))
+        spread = rng.uniform(20., 200., size=(num_clusters, 1))
+        cluster = rng.randint(num_clusters, size=num_cities)
+        points = centers[cluster] + spread[cluster] * rng.standard_normal((num_cities, 2))
+        return np.clip(points, (0., 0.), (WIDTH, HEIGHT))
+    raise ValueError('Unknown layout: %s' % layout)
+
+
+def write_cities(out, num_cities, layout='uniform', seed=0):
+    points = generate_cities(num_cities, layout, seed)
+    pd.DataFrame({'CityId': np.arange(num_cities), 'X': points[:, 0], 'Y': points[:, 1]}).to_csv(out, index=False)
+    return out
+
+
+if __name__ == '__main__':
+    write_cities(sys.argv[1], int(sys.argv[2]), *sys.argv[3:4])
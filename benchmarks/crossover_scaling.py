@@ -0,0 +1,31 @@
+"""
+Microbenchmark of the edge recombination crossover. Prints the time per call and per city for growing tour
+sizes; a constant time per city shows linear scaling.
+
+    python -m benchmarks.crossover_scaling [sizes...]
+"""
+import sys
+import time
+import array
+import numpy as np
+from app.tspea.crossover import edge_recombination
+
+DEFAULT_SIZES = [1000, 10000, 100000, 200000]
+
+
+def main(sizes, repeats=3):
+    print('%10s %12s %16s' % ('cities', 'seconds', 'us per city'))
+    for n in sizes:
+        elapsed = []
+        for _ in range(repeats):
+            ind1 = array.array('i', np.random.permutation(np.arange(1, n, dtype=np.int32)))
+            ind2 = array.array('i', np.random.permutation(np.arange(1, n, dtype=np.int32)))
+            st = time.perf_counter()
+            edge_recombination(ind1, ind2)
+            elapsed.append(time.perf_counter() - st)
+        best = min(elapsed)
+        print('%10d %12.4f %16.3f' % (n, best, 1e6 * best / n))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,181 @@
+"""
+Benchmark suite of the evaluation, the genetic operators, the task serialization, population persistence and a whole
+generation of ea_simple, on synthetic city files. A generation is run against an in-process stand-in of the broker
+which encodes every task, processes it with the worker code and decodes the reply, so it covers everything but the
+network. Results are written as JSON, one record per benchmark and instance size, for comparing runs.
+
+    python -m benchmarks.suite --sizes 1000 10000 --layout clustered --out results.json
+"""
+import os
+import sys
+import json
+import time
+import array
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from deap import base, tools
+from app.tspea.fitness import TSPInstance, EvalTSPSolution, EvalTSPSolutionFragment
+from app.tspea.crossover import edge_recombination
+from app.tspea.mutation import TwoOptMutate
+from app.tspea.population import generate_population, save_population, init_population, write_checkpoint
+from app.tspea.serialization import Codec
+from app.tspea.messaging import TYPE, MATE_MUTATE, ID, GEN, FIRST, SECOND, MUTATE_FIRST, MUTATE_SECOND
+from app.tspea.algorighms import ea_simple
+from app.tspea import worker
+from .cities import write_cities, LAYOUTS
+
+DEFAULT_SIZES = [1000, 10000, 100000, 200000]
+
+
+class InProcessPublisher(object):
+    """Stand-in for TaskPublisher which processes the tasks in this process."""
+    def __init__(self, toolbox, codec):
+        self.toolbox = toolbox
+        self.codec = codec
+
+    def __call__(self, tasks_specs):
+        for task_spec in tasks_specs:
+            task = {k: v for k, v in task_spec.items() if k != ID}
+            results, _ = Codec.decode(worker._process_message(self.codec.encode([task]), toolbox=self.toolbox))
+            result = {ID: task_spec[ID]}
+            result.update(results[0])
+            yield result
+
+
+def _measure(func, setup=lambda: (), repeats=3):
+    """Calls func(*setup()) repeatedly, only the calls are timed."""
+    elapsed = []
+    for _ in range(repeats):
+        args = setup()
+        st = time.perf_counter()
+        func(*args)
+        elapsed.append(time.perf_counter() - st)
+    return {'best': min(elapsed), 'mean': sum(elapsed) / len(elapsed), 'repeats': repeats}
+
+
+def _random_tour(n):
+    return array.array('i', np.random.permutation(np.arange(1, n, dtype=np.int32)))
+
+
+def _mate_mutate_task(n):
+    return {TYPE: MATE_MUTATE, GEN: 1, FIRST: _random_tour(n), SECOND: _random_tour(n),
+            MUTATE_FIRST: True, MUTATE_SECOND: False}
+
+
+def _codec_benchmarks(n, repeats):
+    results = {}
+    for name, codec in (('json', Codec(binary=False)), ('binary', Codec())):
+        task = _mate_mutate_task(n)
+        results['encode_%s' % name] = _measure(lambda: codec.encode([task]), repeats=repeats)
+        body = codec.encode([task])
+        results['decode_%s' % name] = _measure(lambda: Codec.decode(body), repeats=repeats)
+        results['decode_%s' % name]['bytes'] = len(body)
+    return results
+
+
+def _population_benchmarks(n, pop_size, work_dir, repeats):
+    population = generate_population(n, pop_size)
+    for ind in population:
+        ind.fitness.values = random.random(),
+    legacy_dir, checkpoint_dir = os.path.join(work_dir, 'legacy'), os.path.join(work_dir, 'checkpoint')
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint = os.path.join(checkpoint_dir, 'population.bin')
+    fitnesses = [ind.fitness.values[0] for ind in population]
+    return {
+        'save_population': _measure(lambda: save_population(population, legacy_dir), repeats=repeats),
+        'init_population': _measure(lambda: init_population(n, legacy_dir), repeats=repeats),
+        'write_checkpoint': _measure(lambda: write_checkpoint(population, fitnesses, 1, checkpoint), repeats=repeats),
+        'init_population_checkpoint': _measure(lambda: init_population(n, checkpoint_dir), repeats=repeats),
+    }
+
+
+def _generation_benchmark(tsp_instance, pop_size, codec, repeats):
+    worker_toolbox = worker.create_toolbox(tsp_instance)
+    evaluate = EvalTSPSolution(tsp_instance)
+    toolbox = base.Toolbox()
+    toolbox.register('evaluate_population', evaluate.batch)
+    toolbox.register('select', tools.selTournament, tournsize=3)
+    toolbox.register('publish_tasks', InProcessPublisher(worker_toolbox, codec))
+    for name in ('save_population', 'write_stats', 'save_best_individual'):
+        toolbox.register(name, lambda *args, **kwargs: None)
+
+    def setup():
+        population = generate_population(tsp_instance.size(), pop_size)
+        for ind, fit in zip(population, evaluate.batch(population)):
+            ind.fitness.values = fit
+        return population,
+
+    return _measure(lambda population: ea_simple(population, toolbox, 0.8, 0.2, 1, halloffame=tools.HallOfFame(1),
+                                                 verbose=False, start_gen=1), setup, repeats)
+
+
+def run_benchmarks(cities_file, pop_size, work_dir, repeats=3):
+    tsp_instance = TSPInstance(cities_file)
+    n = tsp_instance.size()
+    evaluate = EvalTSPSolution(tsp_instance)
+    evaluate_fragment = EvalTSPSolutionFragment(tsp_instance)
+    mutate = TwoOptMutate(tsp_instance, tsp_instance.nearest_neighbours(worker.NEAREST_NBOURS_SIZE))
+    population = generate_population(n, pop_size)
+    results = {
+        'evaluate': _measure(evaluate, lambda: (_random_tour(n),), repeats),
+        'evaluate_batch': _measure(evaluate.batch, lambda: (population,), repeats),
+        'evaluate_fragment': _measure(lambda ind: evaluate_fragment(ind, ind[n // 4:n // 2], n // 4),
+                                      lambda: (_random_tour(n),), repeats),
+        'edge_recombination': _measure(edge_recombination, lambda: (_random_tour(n), _random_tour(n)), repeats),
+        'two_opt_mutate': _measure(lambda ind: mutate(ind, worker.LSEARCH_NBOUR_SIZE, worker.RAND_SEARCH_PROB),
+                                   lambda: (_random_tour(n),), repeats),
+    }
+    results.update(_codec_benchmarks(n, repeats))
+    results.update(_population_benchmarks(n, pop_size, work_dir, repeats))
+    results['ea_simple_generation'] = _generation_benchmark(tsp_instance, pop_size, Codec(binary=False), repeats)
+    results['ea_simple_generation_binary'] = _generation_benchmark(tsp_instance, pop_size, Codec(), repeats)
+    return results
+
+
+def _environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--layout', choices=LAYOUTS, default='uniform')
+    parser.add_argument('--pop-size', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='JSON output file, standard output by default')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    work_dir = tempfile.mkdtemp(prefix='tspea-bench-')
+    records = []
+    try:
+        for n in args.sizes:
+            cities_file = write_cities(os.path.join(work_dir, 'cities_%d.csv' % n), n, args.layout, args.seed)
+            for name, result in run_benchmarks(cities_file, args.pop_size, os.path.join(work_dir, str(n)),
+                                               args.repeats).items():
+                records.append(dict(benchmark=name, cities=n, layout=args.layout, pop_size=args.pop_size, **result))
+                print('%-28s %8d %12.6f s' % (name, n, result['best']), file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    report = {'environment': _environment(), 'results': records}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from app.tspea.fitness import TSPInstance
+
+
+def write_cities(path, num_cities=300, seed=0):
+    points = np.random.RandomState(seed).uniform(0, 5000, size=(num_cities, 2))
+    with open(path, 'w') as f:
+        f.write('CityId,X,Y\n')
+        for city, (x, y) in enumerate(points):
+            f.write('%d,%f,%f\n' % (city, x, y))
+
+
+@pytest.fixture
+def cities_file(tmp_path):
+    path = str(tmp_path / 'cities.csv')
+    write_cities(path)
+    return path
+
+
+@pytest.fixture
+def tsp_instance(cities_file):
+    return TSPInstance(cities_file)
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(42)
+
+
+def random_tour(tsp_instance, rng):
+    return rng.permutation(np.arange(1, tsp_instance.size())).astype(np.int32)
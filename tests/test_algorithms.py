@@ -0,0 +1,65 @@
+import os
+import random
+
+from deap import base
+
+from app.tspea import master
+from app.tspea.algorighms import _var_and
+from app.tspea.messaging import TYPE, MATE_MUTATE
+from app.tspea.fitness import TSPInstance, EvalTSPSolution
+from app.tspea.population import individual_from, read_checkpoint, CHECKPOINT_FNAME
+
+
+def test_steady_state_optimizes_best_in_windows(cities_file, tmp_path, monkeypatch):
+    # the window tasks are published while offspring of the steady state algorithm are in flight
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    for name, value in dict(POP_SIZE=8, NUM_GENS=4, ALGORITHM='steady_state', TASKS_IN_FLIGHT=4, REPORT_EVERY=8,
+                            OPTIMIZE_BEST='windows', OPTIMIZE_BEST_EVERY=1, NUM_WINDOWS=4).items():
+        monkeypatch.setattr(master, name, value)
+    master.run(cities_file, None, str(out_dir), backend='local')
+
+    tsp_instance = TSPInstance(cities_file)
+    best = individual_from(str(out_dir / 'best_individual.csv'))
+    assert sorted(best) == list(range(1, tsp_instance.size()))
+    with open(os.path.join(str(out_dir), 'stats.csv')) as f:
+        best_in_population = min(float(line.split(',')[2]) for line in f.readlines()[1:])
+    assert EvalTSPSolution(tsp_instance)(best)[0] <= best_in_population
+
+
+def count_stats_records(out_dir):
+    with open(os.path.join(out_dir, 'stats.csv')) as f:
+        return len(f.readlines()) - 1
+
+
+def test_steady_state_resumes_from_checkpoint(cities_file, tmp_path, monkeypatch):
+    out_dir = str(tmp_path / 'out')
+    os.makedirs(out_dir)
+    for name, value in dict(POP_SIZE=8, NUM_GENS=2, ALGORITHM='steady_state', TASKS_IN_FLIGHT=4, REPORT_EVERY=8,
+                            OPTIMIZE_BEST='none').items():
+        monkeypatch.setattr(master, name, value)
+    master.run(cities_file, None, out_dir, backend='local')
+    assert read_checkpoint(os.path.join(out_dir, CHECKPOINT_FNAME))[2] == 2
+    num_records = count_stats_records(out_dir)
+
+    # the resumed run only does the evaluations of the third report
+    monkeypatch.setattr(master, 'NUM_GENS', 3)
+    master.run(cities_file, None, out_dir, backend='local')
+    assert read_checkpoint(os.path.join(out_dir, CHECKPOINT_FNAME))[2] == 3
+    # the statistics of the restored population and of the third report
+    assert count_stats_records(out_dir) == num_records + 2
+
+
+def published_types(population, dedupe):
+    tasks, toolbox = [], base.Toolbox()
+    toolbox.register('clone', individual_from)
+    toolbox.register('publish_tasks', lambda ts: tasks.extend(ts) or [])
+    random.seed(0)
+    _var_and(population, toolbox, cxpb=1., mutpb=0., gen=1, dedupe=dedupe)
+    return [t[TYPE] for t in tasks]
+
+
+def test_identical_parents_are_mated_unless_deduplicating():
+    population = [individual_from([1, 2, 3, 4]) for _ in range(4)]
+    assert published_types(population, dedupe=False) == [MATE_MUTATE, MATE_MUTATE]
+    assert MATE_MUTATE not in published_types(population, dedupe=True)
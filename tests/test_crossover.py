@@ -0,0 +1,96 @@
+import itertools
+from collections import Counter
+from operator import itemgetter
+
+import numpy as np
+
+from app.tspea.crossover import edge_recombination, PartitionCrossover
+from app.tspea.population import individual_from
+from conftest import random_tour
+
+
+def reference_edge_recombination(ind1, ind2):
+    # quadratic implementation the linear one replaced, kept as the reference of the offspring distribution
+    ilen = len(ind1)
+    nlists = np.full((ilen + 1, 4), -1)
+    for ind in (ind1, ind2):
+        for i in range(ilen):
+            k = list(nlists[ind[i]]).index(-1)
+            if i < ilen - 1:
+                nlists[ind[i]][k] = ind[i + 1]
+                k += 1
+            if i > 0:
+                nlists[ind[i]][k] = ind[i - 1]
+    off = []
+    x = ind1[0] if np.random.random() < 0.5 else ind2[0]
+    remaining = np.ones((ilen,), dtype=int)
+    while True:
+        off.append(x)
+        if len(off) >= ilen:
+            return off
+        remaining[x - 1] = 0
+        nlists[nlists == x] = -1
+        if np.any(nlists[x] != -1):
+            counts = [(n, len(nlists[n][nlists[n] != -1])) for n in nlists[x][nlists[x] != -1]]
+            _, fewest = next(itertools.groupby(sorted(counts, key=itemgetter(1))))
+            x = np.random.choice([n[0] for n in fewest])
+        else:
+            i, k = np.random.randint(ilen), 0
+            while True:
+                sign = np.random.choice([-1, 1])
+                if -1 < i + sign * k < ilen and remaining[i + sign * k] != 0:
+                    x = i + sign * k + 1
+                    break
+                if -1 < i - sign * k < ilen and remaining[i - sign * k] != 0:
+                    x = i - sign * k + 1
+                    break
+                k += 1
+
+
+def test_edge_recombination_offspring_is_a_tour(tsp_instance, rng):
+    np.random.seed(0)
+    for _ in range(10):
+        ind1, ind2 = individual_from(random_tour(tsp_instance, rng)), individual_from(random_tour(tsp_instance, rng))
+        off1, off2 = edge_recombination(ind1, ind2)
+        assert sorted(off1) == list(range(1, tsp_instance.size()))
+        assert list(off1) == list(off2)
+
+
+def test_edge_recombination_of_identical_parents_copies_them(tsp_instance, rng):
+    tour = random_tour(tsp_instance, rng)
+    off, _ = edge_recombination(individual_from(tour), individual_from(tour))
+    assert list(off) == tour.tolist()
+
+
+def test_edge_recombination_distribution_matches_the_reference():
+    # parents whose union graph forces restarts, all 8 possible offspring show up
+    parents, samples = [[2, 5, 6, 8, 1, 7, 3, 4], [7, 6, 1, 8, 5, 2, 3, 4]], 4000
+    np.random.seed(0)
+    new = Counter(tuple(edge_recombination(individual_from(parents[0]), individual_from(parents[1]))[0])
+                  for _ in range(samples))
+    old = Counter(tuple(reference_edge_recombination(*parents)) for _ in range(samples))
+    total_variation = sum(abs(new[off] - old[off]) for off in set(new) | set(old)) / (2. * samples)
+    assert total_variation < 0.05
+
+
+def euclidean_length(tsp_instance, ind):
+    tour = np.concatenate(([0], np.asarray(ind), [0]))
+    return np.sum(np.sqrt(np.sum(np.square(np.diff(tsp_instance.cities[tour], axis=0)), axis=1)))
+
+
+def test_partition_crossover_offspring_are_tours_no_longer_than_the_parents(tsp_instance, rng):
+    gpx = PartitionCrossover(tsp_instance)
+    tour = random_tour(tsp_instance, rng)
+    for _ in range(10):
+        # swapping adjacent cities makes components entered and left through two common edges
+        other = tour.copy()
+        for i in rng.choice(np.arange(1, len(tour) - 2, 4), 8, replace=False):
+            other[i], other[i + 1] = other[i + 1], other[i]
+        ind1, ind2 = individual_from(tour), individual_from(other)
+        lengths = euclidean_length(tsp_instance, ind1), euclidean_length(tsp_instance, ind2)
+        off1, off2 = gpx(ind1, ind2)
+        # every component is feasible, both offspring combine the shorter paths of the parents
+        for off in (off1, off2):
+            assert sorted(off) == list(range(1, tsp_instance.size()))
+            assert euclidean_length(tsp_instance, off) <= min(lengths) + 1e-6
+        tour = np.asarray(off1, dtype=np.int32)
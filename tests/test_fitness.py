@@ -0,0 +1,69 @@
+import numpy as np
+
+from app.tspea.fitness import EvalTSPSolution, TourCosts, _MAX_SHIFTS
+from conftest import random_tour
+
+
+def step_by_step_length(tsp_instance, individual):
+    path = [0] + list(individual) + [0]
+    return sum(tsp_instance.step_distance(path[step - 1], path[step], step) for step in range(1, len(path)))
+
+
+def test_lengths_equal_step_by_step_evaluation(tsp_instance, rng):
+    evaluate = EvalTSPSolution(tsp_instance)
+    tours = [random_tour(tsp_instance, rng) for _ in range(5)]
+    expected = [step_by_step_length(tsp_instance, tour) for tour in tours]
+    assert [evaluate(tour)[0] for tour in tours] == expected
+    assert [fitness for fitness, in evaluate.batch(tours)] == expected
+
+
+def test_batch_is_split_into_blocks(tsp_instance, rng, monkeypatch):
+    from app.tspea import fitness
+    evaluate = EvalTSPSolution(tsp_instance)
+    tours = np.stack([random_tour(tsp_instance, rng) for _ in range(7)])
+    expected = evaluate.lengths(tours)
+    monkeypatch.setattr(fitness, '_EVAL_BLOCK_SIZE', 2 * tours.shape[1])
+    assert list(evaluate.lengths(tours)) == list(expected)
+
+
+
+def test_tour_costs_deltas_equal_full_evaluation(tsp_instance, rng):
+    evaluate = EvalTSPSolution(tsp_instance)
+    costs = TourCosts(tsp_instance, random_tour(tsp_instance, rng))
+    n = len(costs.tour())
+    # enough moves to go past the recomputation of the shifted prefix sums
+    for _ in range(3 * _MAX_SHIFTS):
+        before = evaluate(costs.tour())[0]
+        kind = rng.randint(3)
+        if kind == 0:
+            p1, p2 = sorted(rng.choice(n, 2, replace=False))
+            delta = costs.reversal_delta(p1, p2)
+            costs.reverse(p1, p2)
+        elif kind == 1:
+            p1, p2 = rng.choice(n, 2, replace=False)
+            delta = costs.swap_delta(p1, p2)
+            costs.swap(p1, p2)
+        else:
+            s = rng.randint(n - 3)
+            e, q, reverse = s + rng.randint(3), rng.randint(-1, n), bool(rng.randint(2))
+            if s <= q <= e or q == s - 1:
+                continue
+            delta = costs.segment_move_delta(s, e, q, reverse)
+            costs.move_segment(s, e, q, reverse)
+        after = evaluate(costs.tour())[0]
+        assert abs(before + delta - after) < 1e-6
+        assert abs(costs.length() - after) < 1e-6
+        assert all(costs.position[city] == i for i, city in enumerate(costs.tour()))
+
+
+def test_tour_costs_of_a_window(tsp_instance, rng):
+    tour = random_tour(tsp_instance, rng)
+    costs = TourCosts(tsp_instance, tour)
+    lo, hi = 23, 80
+    window = TourCosts(tsp_instance, tour[lo:hi + 1], start=tour[lo - 1], end=tour[hi + 1], offset=lo)
+    assert abs(window.length() - costs.edges_cost(lo + 1, hi + 2)) < 1e-6
+    for p1, p2 in ((3, 40), (0, 57), (10, 11)):
+        assert abs(window.reversal_delta(p1, p2) - costs.reversal_delta(lo + p1, lo + p2)) < 1e-6
+        window.reverse(p1, p2)
+        costs.reverse(lo + p1, lo + p2)
+    assert list(window.tour()) == list(costs.tour()[lo:hi + 1])
@@ -0,0 +1,36 @@
+import numpy as np
+
+from app.tspea.population import write_checkpoint, read_checkpoint, init_population, individual_from, \
+    CheckpointWriter, CHECKPOINT_FNAME
+from conftest import random_tour
+
+
+def test_checkpoint_round_trip(tsp_instance, rng, tmp_path):
+    tours = np.stack([random_tour(tsp_instance, rng) for _ in range(4)])
+    out = str(tmp_path / CHECKPOINT_FNAME)
+    write_checkpoint(tours, [1.5, None, 3., 4.25], 7, out)
+    read_tours, fitnesses, generation = read_checkpoint(out)
+    assert np.array_equal(read_tours, tours)
+    assert fitnesses == [1.5, None, 3., 4.25]
+    assert generation == 7
+    assert read_tours.offset % 64 == 0
+
+    population = init_population(tsp_instance.size(), str(tmp_path))
+    assert [list(ind) for ind in population] == tours.tolist()
+    assert [ind.fitness.valid for ind in population] == [True, False, True, True]
+    assert population[0].fitness.values == (1.5,)
+
+
+def test_checkpoint_writer_keeps_the_skipped_generation(tsp_instance, rng, tmp_path):
+    writer = CheckpointWriter(str(tmp_path), every=3)
+    population = [individual_from(random_tour(tsp_instance, rng)) for _ in range(3)]
+    for ind in population:
+        ind.fitness.values = 1.,
+    writer(population, gen=1)
+    snapshot = [list(ind) for ind in population]
+    # the next generation replaces individuals before the writer is closed
+    population[0] = individual_from(random_tour(tsp_instance, rng))
+    writer.close()
+    tours, _, generation = read_checkpoint(str(tmp_path / CHECKPOINT_FNAME))
+    assert generation == 1
+    assert tours.tolist() == snapshot
@@ -0,0 +1,45 @@
+import array
+
+import numpy as np
+import pytest
+
+from app.tspea.serialization import Codec, _ALIGNMENT
+
+
+def messages():
+    return [{'type': 'mutate', 'gen': 3, '_1': array.array('i', [5, 3, 1, 4, 2])},
+            {'type': 'mate', 'gen': 3, '_1': np.arange(7, dtype=np.int32), '_2': np.arange(6, 0, -1, dtype=np.int32),
+             'fitness': 12.5}]
+
+
+@pytest.mark.parametrize('codec', [Codec(), Codec(compress_level=1), Codec(binary=False)],
+                         ids=['binary', 'compressed', 'json'])
+def test_round_trip(codec):
+    decoded, reply_codec = Codec.decode(codec.encode(messages()))
+    assert reply_codec.binary == codec.binary
+    assert len(decoded) == 2
+    for original, message in zip(messages(), decoded):
+        assert set(message) == set(original)
+        for key, value in original.items():
+            if isinstance(value, (array.array, np.ndarray)):
+                assert list(message[key]) == list(value)
+            else:
+                assert message[key] == value
+
+
+def test_json_single_message_is_an_object():
+    message = messages()[0]
+    assert Codec(binary=False).encode([message]).startswith(b'{')
+    decoded, _ = Codec.decode(Codec(binary=False).encode([message]))
+    assert list(decoded[0]['_1']) == list(message['_1'])
+
+
+@pytest.mark.parametrize('compress_level', [0, 1])
+def test_arrays_are_aligned(compress_level):
+    for length in range(1, 10):
+        body = Codec(compress_level=compress_level).encode([{'type': 'x' * length,
+                                                             '_1': np.arange(length, dtype=np.int32),
+                                                             '_2': np.arange(length + 1, dtype=np.int32)}])
+        decoded, _ = Codec.decode(body)
+        for key in ('_1', '_2'):
+            assert decoded[0][key].ctypes.data % _ALIGNMENT == 0